@@ -0,0 +1,360 @@
+#! python3
+import os
+import sys
+import json
+import time
+import fire
+import random
+import shutil
+import socket
+import pathlib
+import hashlib
+import secrets
+import asyncio
+import platform
+import tempfile
+import datetime
+import resource
+import threading
+import contextlib
+import subprocess
+import http.server
+import olog
+
+
+class Legacy:
+
+    def __init__(self, token):
+        self.olog_cfg = {'token': token}
+
+    def add_auth(self, payload):
+        nowtime = time.time()
+        result = {
+            'payload': payload,
+            'timestamp': nowtime,
+            'checksum': hashlib.sha256((payload + str(nowtime) + self.olog_cfg['token']).encode('utf-8')).hexdigest()
+        }
+        return json.dumps(result)
+
+    def fetch_auth(self, data):
+        data = json.loads(data)
+        if abs(data.get('timestamp', 0) - time.time()) < 10:
+            checksum = hashlib.sha256((data.get('payload') + str(data.get('timestamp', '')) + self.olog_cfg['token']).encode('utf-8')).hexdigest()
+            if checksum == data.get('checksum', ''):
+                return data.get('payload', '')
+        return False
+
+
+class PushStub:
+
+    def __init__(self):
+        self.received = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                stub.received.append((time.time(), json.loads(body)))
+                reply = b'{"code":1000,"success":true}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/send/message'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_for(self, text, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for received, data in self.received:
+                if text in data['summary']:
+                    return received
+            time.sleep(0.005)
+        return None
+
+    def close(self):
+        self.server.shutdown()
+
+
+class Bench:
+
+    def __init__(self, workdir=None):
+        self.workdir = pathlib.Path(workdir or tempfile.mkdtemp(prefix='olog_bench_'))
+
+    def percentiles(self, values):
+        if not values:
+            return {}
+        values = sorted(values)
+        pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        return {
+            'n': len(values),
+            'p50': round(pick(0.5), 6),
+            'p90': round(pick(0.9), 6),
+            'p99': round(pick(0.99), 6),
+            'max': round(values[-1], 6)
+        }
+
+    def rate(self, func, n):
+        start = time.perf_counter()
+        for i in range(n):
+            func()
+        return round(n / (time.perf_counter() - start))
+
+    def free_port(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def write_cfg(self, name, **kwargs):
+        cfg = {
+            'device': f'{name}#bench@127.0.0.1:22',
+            'log_dirs': [],
+            'log_keep_days': 360,
+            'report_time': '11:00',
+            'svr_ip': '127.0.0.1',
+            'svr_port': 8765,
+            'token': 'AT_' + 'b' * 32,
+            'uids': ['UID_bench'],
+            'state_path': str(self.workdir / f'{name}.db'),
+            'history_path': str(self.workdir / f'{name}_history.db'),
+            'tasks_state_path': str(self.workdir / f'{name}_tasks.json'),
+            'retention_path': str(self.workdir / f'{name}_retention.db'),
+            'push_interval': 0,
+            'push_dedup_seconds': 0
+        }
+        cfg.update(kwargs)
+        path = self.workdir / f'{name}.cfg'
+        with path.open('w', encoding='utf-8') as fw:
+            json.dump(cfg, fw, indent=4)
+        return path
+
+    def gen_tree(self, root, files=10000, depth=3, fanout=8, size=2048, tasks=200, err_ratio=0.1, seed=1):
+        random.seed(seed)
+        root = pathlib.Path(root)
+        shutil.rmtree(root, ignore_errors=True)
+        dirs = [root]
+        for level in range(depth):
+            dirs += [d / f'd{level}_{i}' for d in dirs if len(d.parts) - len(root.parts) == level for i in range(fanout)]
+        for d in dirs:
+            d.mkdir(parents=True, exist_ok=True)
+        line = 'bench log line 0123456789 abcdefghijklmnopqrstuvwxyz\n'
+        body = (line * (size // len(line) + 1))[:size]
+        for i in range(files):
+            ext = 'err' if random.random() < err_ratio else random.choice(['log', 'log', 'txt'])
+            path = random.choice(dirs) / f'{i}@task{random.randrange(tasks)}@.{ext}'
+            with path.open('w', encoding='utf-8') as fw:
+                fw.write(body)
+        return {'files': files, 'dirs': len(dirs), 'size': size, 'tasks': tasks}
+
+    def auth(self, n=100000):
+        token = 'AT_' + secrets.token_hex(16)
+        legacy = Legacy(token)
+        sender = olog.Channel(legacy, None)
+        receiver = olog.Channel(legacy, None)
+        key = secrets.token_bytes(32)
+        sender.set_key(key)
+        receiver.set_key(key)
+        report = {f'task{i}': {'state': 'ok', 'logdate': '2021-01-01 11:00:00', 'detail': 'x' * 100} for i in range(20)}
+        results = {}
+        # legacy scheme: ping/pong as plain strings, reports as a JSON string inside the JSON envelope
+        results['legacy_ping'] = self.rate(lambda: legacy.fetch_auth(legacy.add_auth('ping')), n)
+        results['legacy_report'] = self.rate(lambda: json.loads(legacy.fetch_auth(legacy.add_auth(json.dumps(report)))), n // 10)
+        results['frame_ping'] = self.rate(lambda: receiver.unpack(sender.pack('ping', None, 1)), n)
+        results['frame_report'] = self.rate(lambda: receiver.unpack(sender.pack('state', report, 1)), n // 10)
+        results['ping_speedup'] = round(results['frame_ping'] / results['legacy_ping'], 2)
+        results['report_speedup'] = round(results['frame_report'] / results['legacy_report'], 2)
+        return results
+
+    def scan(self, files=10000, depth=3, size=2048, tasks=200):
+        tree = self.gen_tree(self.workdir / 'scan_logs', files, depth, size=size, tasks=tasks)
+        client = olog.OlogClient(self.write_cfg('scan', log_dirs=[str(self.workdir / 'scan_logs')]))
+        results = {'tree': tree}
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            for name in ['scan_cold', 'scan_warm']:
+                start = time.perf_counter()
+                found = client.scan_logs()
+                results[name] = round(time.perf_counter() - start, 4)
+        results['tasks_found'] = len(found)
+        start = time.perf_counter()
+        watcher = olog.PollingWatcher(client.watch_rules())
+        watcher.scan()
+        results['poll_cold'] = round(time.perf_counter() - start, 4)
+        start = time.perf_counter()
+        watcher.scan()
+        results['poll_warm'] = round(time.perf_counter() - start, 4)
+        return results
+
+    async def alert_run(self, client, stub, samples):
+        latencies = []
+        tasks = [asyncio.ensure_future(client.watch()), asyncio.ensure_future(client.dispatcher.run())]
+        await asyncio.sleep(2)
+        loop = asyncio.get_event_loop()
+        for i in range(samples):
+            task = f'alert{i}_{secrets.token_hex(4)}'
+            written = time.time()
+            with (self.workdir / 'alert_logs' / f'@{task}@.err').open('w', encoding='utf-8') as fw:
+                fw.write(f'{task} failed\n')
+            received = await loop.run_in_executor(None, stub.wait_for, task)
+            if received is not None:
+                latencies.append(received - written)
+        for task in tasks:
+            task.cancel()
+        return latencies
+
+    def alert(self, samples=20, files=10000):
+        tree = self.gen_tree(self.workdir / 'alert_logs', files, 3, size=256)
+        stub = PushStub()
+        results = {'tree': tree}
+        try:
+            for backend in ['inotify', 'poll']:
+                client = olog.OlogClient(self.write_cfg(f'alert_{backend}', log_dirs=[str(self.workdir / 'alert_logs')], watch_backend=backend, push_url=stub.url))
+                latencies = asyncio.run(self.alert_run(client, stub, samples))
+                results[backend] = self.percentiles(latencies)
+                client.state.close()
+        finally:
+            stub.close()
+        return results
+
+    def serve(self, cfg, seconds):
+        # runs in a child process so its CPU time can be measured on its own
+        import websockets
+        server = olog.OlogSvr(cfg)
+        # the pong round trips HeartbeatScheduler reports as olog_heartbeat_rtt_seconds, kept unbucketed
+        rtts = []
+        observe = server.metrics.observe
+
+        def record(name, value, **labels):
+            if name == 'olog_heartbeat_rtt_seconds':
+                rtts.append(value)
+            observe(name, value, **labels)
+
+        server.metrics.observe = record
+
+        async def main():
+            async with websockets.serve(server.ws_svr, '127.0.0.1', server.olog_cfg['svr_port'], max_queue=None, ping_interval=None):
+                tasks = [asyncio.ensure_future(server.dispatcher.run()), asyncio.ensure_future(server.heartbeat.run())]
+                await asyncio.sleep(seconds)
+                for task in tasks:
+                    task.cancel()
+
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            asyncio.run(main())
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print(json.dumps({'cpu': usage.ru_utime + usage.ru_stime, 'rtts': rtts}))
+
+    async def fanin_run(self, cfg, clients, seconds):
+        devices = []
+        tasks = []
+        for i in range(clients):
+            client = olog.OlogClient(cfg)
+            client.olog_cfg['device'] = f'bench{i}#bench@127.0.0.1:22'
+            devices.append(client)
+            tasks.append(asyncio.ensure_future(client.client()))
+        deadline = time.time() + 60
+        while any(client.channel is None for client in devices) and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        connected = sum(client.channel is not None for client in devices)
+        # idle clients only answer the server's heartbeat pings, which the server measures
+        await asyncio.sleep(seconds)
+        for task in tasks:
+            task.cancel()
+        return connected
+
+    def fanin(self, clients=100, seconds=20, interval=1):
+        port = self.free_port()
+        stub = PushStub()
+        try:
+            server_cfg = self.write_cfg('fanin_server', svr_port=port, push_url=stub.url, heartbeat_interval=interval)
+            client_cfg = self.write_cfg('fanin_client', svr_port=port, push_url=stub.url)
+            server = subprocess.Popen([sys.executable, __file__, 'serve', str(server_cfg), str(seconds + 15), f'--workdir={self.workdir}'], stdout=subprocess.PIPE)
+            time.sleep(2)
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                connected = asyncio.run(self.fanin_run(client_cfg, clients, seconds))
+            usage = json.loads(server.communicate()[0].decode('utf-8').strip().splitlines()[-1])
+            cpu = usage['cpu']
+            rtts = usage['rtts']
+        finally:
+            stub.close()
+        return {
+            'clients': clients,
+            'connected': connected,
+            'seconds': seconds,
+            'heartbeat_rtt': self.percentiles(rtts),
+            'server_cpu_seconds': round(cpu, 3),
+            'server_cpu_per_device': round(cpu / max(connected, 1), 5)
+        }
+
+    def report(self, devices=1000, tasks=50):
+        server = olog.OlogSvr(self.write_cfg('report', htmldir=str(self.workdir / 'html'), htmlurl='http://127.0.0.1/'))
+        reports = {
+            f'bench{d}#bench@127.0.0.1:22': {
+                f'task{t}': {'state': 'err' if (d + t) % 17 == 0 else 'ok', 'logdate': '2021-01-01 11:00:00', 'detail': 'bench detail ' * 4}
+                for t in range(tasks)
+            } for d in range(devices)
+        }
+        versions = {device: 1 for device in reports}
+        results = {'devices': devices, 'tasks': tasks}
+        # the first render records every task as known, which changes each device's fragment key
+        server.render_report(reports, versions)
+        server.renderer.fragments.clear()
+        for name in ['gen_html_cold', 'gen_html_warm']:
+            start = time.perf_counter()
+            html = server.render_report(reports, versions)
+            results[name] = round(time.perf_counter() - start, 4)
+        start = time.perf_counter()
+        server.save_html(html)
+        results['save_html'] = round(time.perf_counter() - start, 4)
+        return results
+
+    def all(self, out='bench_results', files=10000, clients=100, seconds=20, devices=1000, tasks=50, samples=20):
+        results = {
+            'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pathlib.Path(__file__).parent, capture_output=True, text=True).stdout.strip(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'auth': self.auth(),
+            'scan': self.scan(files),
+            'alert': self.alert(samples, files),
+            'fanin': self.fanin(clients, seconds),
+            'report': self.report(devices, tasks)
+        }
+        out = pathlib.Path(out)
+        out.mkdir(parents=True, exist_ok=True)
+        path = out / f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}_{results["commit"] or "nogit"}.json'
+        with path.open('w', encoding='utf-8') as fw:
+            json.dump(results, fw, indent=4)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        print(f'[NOTICE] results saved to {path}')
+        return results
+
+    def compare(self, old, new):
+        def flatten(data, prefix=''):
+            items = {}
+            for key, value in data.items():
+                if isinstance(value, dict):
+                    items.update(flatten(value, f'{prefix}{key}.'))
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    items[f'{prefix}{key}'] = value
+            return items
+        with open(old, encoding='utf-8') as fr:
+            old = flatten(json.load(fr))
+        with open(new, encoding='utf-8') as fr:
+            new = flatten(json.load(fr))
+        lines = []
+        for key in sorted(set(old) & set(new)):
+            change = f'{(new[key] - old[key]) / old[key] * 100:+.1f}%' if old[key] else ''
+            lines.append(f'{key:40} {old[key]:>14} {new[key]:>14} {change:>9}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    fire.Fire(Bench)
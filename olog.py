@@ -5,86 +5,373 @@ import sys
 import time
 import fire
 import json
+import gzip
+import zlib
+import hmac
+import codecs
+import contextlib
 import shutil
 import pathlib
+import ctypes
+import struct
+import sqlite3
 import hashlib
+import fnmatch
+import heapq
+import secrets
 import asyncio
+import functools
+import itertools
+import threading
+import ctypes.util
 import datetime
+import multiprocessing
+import traceback
+import collections
+import urllib.parse
+import concurrent.futures
 import requests
 import websockets
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
-class Olog:
+class Metrics:
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
 
     def __init__(self):
-        self.olog_cfg_path = pathlib.Path(__file__).parent / 'olog.cfg'
-        self.olog_cfg_st_mtime = 0
-        self.olog_cfg = {}
-        self.read_olog_config()
-        self.last_wechat_send_time = 0
-        self.scan_results = {}
-        self.watch_exts = ['err', 'msg']
-        self.msgs = []
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.types = {}
+        self.collectors = []
 
-    def sendmsg(self, title, content, type_):
-        self.msgs.append({
-            'title': title,
-            'content': content,
-            'type_': type_
-        })
-        return True
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
 
-    async def wechat_send(self):
-        while True:
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.types[name] = 'counter'
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.types[name] = 'gauge'
+            self.values[self.key(name, labels)] = value
+
+    def remove(self, name, **labels):
+        with self.lock:
+            self.values.pop(self.key(name, labels), None)
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.types[name] = 'histogram'
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bucket in enumerate(self.BUCKETS):
+                if value <= bucket:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+    def render(self):
+        for collector in self.collectors:
             try:
-                if len(self.msgs) > 0:
-                    while time.time() - self.last_wechat_send_time < 10:
-                        await asyncio.sleep(1)
-                    self.last_wechat_send_time = time.time()
-                    msg = self.msgs[0]
-                    title = msg['title']
-                    content = msg['content']
-                    type_ = msg['type_']
-                    URL = 'http://wxpusher.zjiecode.com/api/send/message'
-                    data = {
-                        'appToken': self.olog_cfg['token'],
-                        'content': content,
-                        'summary': '[Olog] ' + title,
-                        'contentType': type_,  # 1 string, 2 html, 3 markdown
-                        'uids': self.olog_cfg['uids']
-                    }
-                    r = requests.post(URL, json=data)
-                    if r.ok:
-                        del self.msgs[0]
+                collector(self)
             except Exception as e:
                 print(e, file=sys.stderr)
-            await asyncio.sleep(1)
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.values.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} {self.types[name]}')
+                    typed.add(name)
+                lines.append(f'{name}{self.labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                count = 0
+                for bucket, n in zip(self.BUCKETS, histogram):
+                    count += n
+                    lines.append(f'{name}_bucket{self.labels(labels, [("le", bucket)])} {count}')
+                lines.append(f'{name}_bucket{self.labels(labels, [("le", "+Inf")])} {histogram[-1]}')
+                lines.append(f'{name}_sum{self.labels(labels)} {histogram[-2]}')
+                lines.append(f'{name}_count{self.labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+
+    def __init__(self):
+        self.thread = None
+        self.running = False
+        self.interval = 0.01
+        self.samples = 0
+        self.stacks = collections.Counter()
+
+    def start(self, interval=0.01):
+        if self.running:
+            return False
+        self.interval = interval
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, name='olog-profiler', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.report()
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {}
+        while self.running:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [f'{f.f_code.co_filename.split(os.sep)[-1]}:{f.f_code.co_name}:{lineno}' for f, lineno in traceback.walk_stack(frame)]
+                self.stacks[names.get(ident, str(ident)) + ';' + ';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def report(self):
+        # collapsed stacks, one per line, ready for flamegraph.pl or speedscope
+        lines = [f'{stack} {count}' for stack, count in self.stacks.most_common()]
+        return f'# samples: {self.samples} interval: {self.interval}\n' + '\n'.join(lines) + '\n'
+
+
+class Dispatcher:
+
+    PRIORITY_ALERT = 0
+    PRIORITY_NOTICE = 1
+    URL = 'http://wxpusher.zjiecode.com/api/send/message'
+    DIGEST_MAX_CHARS = 30000
+
+    def __init__(self, olog):
+        self.olog = olog
+        self.queues = {self.PRIORITY_ALERT: collections.deque(), self.PRIORITY_NOTICE: collections.deque()}
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.dropped = 0
+        self.last_send_time = 0
+        self.loop = None
+        self.wakeup = None
+        self.session = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='olog-push')
+
+    def cfg(self, key, default):
+        return self.olog.olog_cfg.get(key, default)
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, title, content, type_, priority=PRIORITY_NOTICE):
+        key = hashlib.sha1(f'{type_}\n{title}\n{content}'.encode('utf-8')).hexdigest()
+        with self.lock:
+            if time.time() - self.sent.get(key, 0) < self.cfg('push_dedup_seconds', 600):
+                return False
+            for queue in self.queues.values():
+                for msg in queue:
+                    if msg['key'] == key:
+                        msg['count'] += 1
+                        return True
+            if self.depth() >= self.cfg('push_queue_size', 100):
+                # backpressure: drop the oldest message of the lowest priority not above this one
+                victims = [queue for p, queue in self.queues.items() if p >= priority and queue]
+                if not victims:
+                    self.dropped += 1
+                    self.olog.metrics.inc('olog_push_dropped_total')
+                    return False
+                victims[-1].popleft()
+                self.dropped += 1
+                self.olog.metrics.inc('olog_push_dropped_total')
+            self.queues[priority].append({
+                'key': key,
+                'title': title,
+                'content': content,
+                'type_': type_,
+                'priority': priority,
+                'count': 1
+            })
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return True
+
+    def next_batch(self):
+        with self.lock:
+            queue = [queue for queue in self.queues.values() if queue][0]
+            if self.depth() < self.cfg('push_coalesce', 3):
+                return [queue.popleft()]
+            type_ = queue[0]['type_']
+            batch = []
+            size = 0
+            for queue in self.queues.values():
+                for msg in list(queue):
+                    if msg['type_'] != type_ or (batch and size + len(msg['content']) > self.DIGEST_MAX_CHARS):
+                        continue
+                    queue.remove(msg)
+                    batch.append(msg)
+                    size += len(msg['content'])
+            return batch
+
+    def requeue(self, batch):
+        with self.lock:
+            for msg in reversed(batch):
+                self.queues[msg['priority']].appendleft(msg)
 
-    def add_auth(self, payload):
-        nowtime = time.time()
-        result = {
-            'payload': payload,
-            'timestamp': nowtime,
-            'checksum': hashlib.sha256((payload + str(nowtime) + self.olog_cfg['token']).encode('utf-8')).hexdigest()
+    def render(self, batch):
+        titles = [msg['title'] + (f' (x{msg["count"]})' if msg['count'] > 1 else '') for msg in batch]
+        if len(batch) == 1:
+            return titles[0], batch[0]['content'], batch[0]['type_']
+        type_ = batch[0]['type_']
+        title = f'{len(batch)} messages: {titles[0]} ...'
+        if type_ == 2:
+            content = '<hr>'.join(f'<h2>{t}</h2>{msg["content"]}' for t, msg in zip(titles, batch))
+        elif type_ == 3:
+            content = '\n\n---\n\n'.join(f'# {t}\n\n{msg["content"]}' for t, msg in zip(titles, batch))
+        else:
+            content = '\n\n'.join(f'{t}\n{msg["content"]}' for t, msg in zip(titles, batch))
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            content += f'\n\n{dropped} messages dropped because the push queue was full.'
+        return title, content, type_
+
+    def post(self, title, content, type_):
+        if self.session is None:
+            self.session = requests.Session()
+        data = {
+            'appToken': self.olog.olog_cfg['token'],
+            'content': content,
+            'summary': '[Olog] ' + title,
+            'contentType': type_,  # 1 string, 2 html, 3 markdown
+            'uids': self.olog.olog_cfg['uids']
         }
-        result = json.dumps(result)
-        return result
-    
-    def fetch_auth(self, data):
-        if isinstance(data, str) and '{' in data:
-            data = json.loads(data)
-            if abs(data.get('timestamp', 0) - time.time()) < 10:
-                checksum = hashlib.sha256((data.get('payload') + str(data.get('timestamp', '')) + self.olog_cfg['token']).encode('utf-8')).hexdigest()
-                if checksum == data.get('checksum', ''):
-                    return data.get('payload', '')
+        r = self.session.post(self.cfg('push_url', self.URL), json=data, timeout=30)
+        return r.ok
+
+    async def run(self):
+        self.loop = asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                if self.depth() == 0:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                await asyncio.sleep(max(0, self.last_send_time + self.cfg('push_interval', 10) - time.time()))
+                self.last_send_time = time.time()
+                batch = self.next_batch()
+                title, content, type_ = self.render(batch)
+                start = time.perf_counter()
+                try:
+                    ok = await self.loop.run_in_executor(self.executor, self.post, title, content, type_)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                    ok = False
+                self.olog.metrics.observe('olog_push_seconds', time.perf_counter() - start)
+                self.olog.metrics.inc('olog_push_messages_total', len(batch))
+                if ok:
+                    with self.lock:
+                        for msg in batch:
+                            self.sent[msg['key']] = time.time()
+                        expire = time.time() - self.cfg('push_dedup_seconds', 600)
+                        self.sent = {key: t for key, t in self.sent.items() if t > expire}
                 else:
-                    print(f'[ERROR] fetch auth checksum error!', file=sys.stderr)
+                    self.olog.metrics.inc('olog_push_failures_total')
+                    self.requeue(batch)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                await asyncio.sleep(1)
+
+
+class Olog:
+
+    def __init__(self, olog_cfg_path=None):
+        self.olog_cfg_path = pathlib.Path(olog_cfg_path or pathlib.Path(__file__).parent / 'olog.cfg')
+        self.olog_cfg_st_mtime = 0
+        self.olog_cfg = {}
+        self.read_olog_config()
+        self.scan_results = {}
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.profiler = SamplingProfiler()
+        self.dispatcher = Dispatcher(self)
+
+    def sendmsg(self, title, content, type_, priority=1):
+        return self.dispatcher.put(title, content, type_, priority)
+
+    def collect_metrics(self, metrics):
+        metrics.set('olog_push_queue_depth', self.dispatcher.depth())
+
+    async def metrics_handler(self, reader, writer):
+        try:
+            request = (await asyncio.wait_for(reader.readline(), 10)).decode('latin-1').split()
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            url = urllib.parse.urlsplit(request[1] if len(request) > 1 else '/')
+            query = urllib.parse.parse_qs(url.query)
+            status = '200 OK'
+            if url.path == '/metrics':
+                body = self.metrics.render()
+            elif url.path == '/profile/start':
+                started = self.profiler.start(float(query.get('interval', ['0.01'])[0]))
+                body = 'profiler started\n' if started else 'profiler already running\n'
+            elif url.path == '/profile/stop':
+                body = self.profiler.stop()
+            elif url.path == '/profile':
+                body = self.profiler.report()
             else:
-                print(f'[ERROR] fetch auth checksum timestamp timeout!', file=sys.stderr)
-        else:
-            print(f'[ERROR] fetch auth data is not json str', file=sys.stderr)
-        return False
-    
+                status = '404 Not Found'
+                body = 'not found\n'
+            body = body.encode('utf-8')
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except Exception as e:
+            print(e, file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def serve_metrics(self):
+        if not self.olog_cfg.get('metrics_port'):
+            return
+        server = await asyncio.start_server(self.metrics_handler, self.olog_cfg.get('metrics_host', '127.0.0.1'), self.olog_cfg['metrics_port'])
+        print(f'[NOTICE] metrics on http://{self.olog_cfg.get("metrics_host", "127.0.0.1")}:{self.olog_cfg["metrics_port"]}/metrics')
+        async with server:
+            await server.serve_forever()
+
     def read_olog_config(self):
         if self.olog_cfg_st_mtime == self.olog_cfg_path.stat().st_mtime:
             return
@@ -119,68 +406,1357 @@ class Olog:
         self.olog_cfg_st_mtime = self.olog_cfg_path.stat().st_mtime
 
 
+class LogSummarizer:
+
+    SEPARATOR = '...\n......\n...'
+    WHITESPACE = b' \t\n\r\x0b\x0c'
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def decode(data):
+        text = codecs.getincrementaldecoder('utf-8')('replace').decode(data, final=False)
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    def read(self, p, st, keep, limit, strip):
+        if RetentionService.compressed(str(p)):
+            with RetentionService.open(p) as fr:
+                head, tail = self.read_stream(fr, keep, limit, strip)
+        else:
+            with p.open('rb') as fr:
+                head, tail = self.read_file(fr, st.st_size, keep, limit, strip)
+        if tail is None:
+            detail = self.decode(head)
+            if strip:
+                detail = detail.strip()
+            if len(detail) > limit:
+                detail = detail[:keep] + self.SEPARATOR + detail[-keep:]
+            return detail
+        # skip continuation bytes of a char cut by the seek
+        start = 0
+        while start < 3 and start < len(tail) and 0x80 <= tail[start] < 0xc0:
+            start += 1
+        head = self.decode(head[:keep * 4])
+        tail = self.decode(tail[start:])
+        if strip:
+            head = head.lstrip()
+            tail = tail.rstrip()
+        return head[:keep] + self.SEPARATOR + tail[-keep:]
+
+    @classmethod
+    def read_file(cls, fr, size, keep, limit, strip):
+        # (content, None) when the stripped content fits in limit chars, otherwise its head and tail bytes
+        start, end = 0, size
+        if strip:
+            # whitespace runs can be longer than the head or tail window, skip them first
+            while start < end:
+                fr.seek(start)
+                chunk = fr.read(min(65536, end - start))
+                if not chunk:
+                    end = start
+                    break
+                stripped = chunk.lstrip(cls.WHITESPACE)
+                start += len(chunk) - len(stripped)
+                if stripped:
+                    break
+            while end > start:
+                n = min(65536, end - start)
+                fr.seek(end - n)
+                chunk = fr.read(n)
+                stripped = chunk.rstrip(cls.WHITESPACE)
+                end -= n - len(stripped)
+                if stripped:
+                    break
+        fr.seek(start)
+        # a UTF-8 char is at most 4 bytes, so content this small may fit in limit chars
+        if end - start <= limit * 4:
+            return fr.read(end - start), None
+        head = fr.read(keep * 4)
+        fr.seek(end - keep * 4)
+        return head, fr.read(keep * 4)
+
+    @classmethod
+    def read_stream(cls, fr, keep, limit, strip):
+        # compressed logs cannot seek: stream them, keeping the first limit * 4 bytes and a keep * 4 byte tail window
+        data = b''
+        tail = b''
+        spaces = b''
+        spaces_size = 0
+        size = 0
+        started = not strip
+        while True:
+            chunk = fr.read(65536)
+            if not chunk:
+                break
+            if not started:
+                chunk = chunk.lstrip(cls.WHITESPACE)
+                if not chunk:
+                    continue
+                started = True
+            if len(data) <= limit * 4:
+                data += chunk[:limit * 4 + 1 - len(data)]
+            body = chunk.rstrip(cls.WHITESPACE) if strip else chunk
+            if body:
+                # trailing whitespace only counts once content follows it
+                tail = (tail + spaces + body)[-keep * 4:]
+                size += spaces_size + len(body)
+                spaces = b''
+                spaces_size = 0
+            rest = chunk[len(body):]
+            spaces = (spaces + rest)[-keep * 4:]
+            spaces_size += len(rest)
+        if size <= limit * 4:
+            return data[:size], None
+        return data, tail
+
+    def summary(self, p, st, keep, limit, strip=False):
+        path = str(p)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, keep, limit, strip)
+        with self.lock:
+            cached = self.cache.get((path, keep))
+            if cached is not None and cached[0] == key:
+                self.cache.move_to_end((path, keep))
+                return cached[1]
+        detail = self.read(p, st, keep, limit, strip)
+        with self.lock:
+            self.cache[(path, keep)] = (key, detail)
+            self.cache.move_to_end((path, keep))
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return detail
+
+
+class WatchRule:
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.include = self.globs(spec['include'])
+        self.exclude = self.globs(spec['exclude'])
+        self.task_pattern = re.compile(spec['task_pattern'])
+        # the report, the OK count and the history only know these two states
+        for ext, state in spec['states'].items():
+            if state not in ['ok', 'err']:
+                raise ValueError(f'watch_rules: state of .{ext} must be "ok" or "err", not {state!r}')
+        # ext -> (state, alert, forward), one dict lookup classifies a file name
+        self.exts = {}
+        for ext in set(spec['states']) | set(spec['alerts']) | set(spec['forward']):
+            self.exts[ext.lower()] = (spec['states'].get(ext), ext in spec['alerts'], ext in spec['forward'])
+
+    @staticmethod
+    def globs(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in patterns))
+
+    def task(self, stem):
+        m = self.task_pattern.search(stem)
+        if m is None:
+            return stem
+        return m.group(1) if m.groups() else m.group(0)
+
+
+class WatchRules:
+
+    DEFAULT = {
+        'include': [],
+        'exclude': [],
+        'states': {'log': 'ok', 'err': 'err', 'scanerr': 'err'},
+        'alerts': ['err', 'msg'],
+        'task_pattern': r'@(.*?)@'
+    }
+
+    def __init__(self, log_dirs, rules=None, forward_exts=()):
+        rules = dict(rules or {})
+        base = dict(self.DEFAULT, forward=sorted(forward_exts))
+        base.update(rules.pop('*', {}))
+        self.log_dirs = [os.path.abspath(log_dir) for log_dir in log_dirs]
+        self.specs = {log_dir: base for log_dir in self.log_dirs}
+        for d, spec in rules.items():
+            self.specs[os.path.abspath(d)] = dict(base, **spec)
+        self.rules = {d: WatchRule(spec) for d, spec in self.specs.items()}
+        self.dirs = {}
+
+    def __getstate__(self):
+        # the per-directory cache grows with the tree, scan workers rebuild what they need
+        state = dict(self.__dict__)
+        state['dirs'] = {}
+        return state
+
+    def rule(self, d):
+        # the most specific rule directory containing d and whether d lies in an excluded subtree, cached per directory
+        cached = self.dirs.get(d)
+        if cached is None:
+            root = d
+            while root not in self.rules:
+                root, child = os.path.split(root)
+                if not child:
+                    break
+            rule = self.rules.get(root)
+            pruned = False
+            if rule is not None and rule.exclude is not None and d != root:
+                rel = d[len(root) + 1:]
+                pruned = bool(rule.exclude.match(rel) or rule.exclude.match(rel + '/')) or self.rule(os.path.dirname(d))[2]
+            cached = self.dirs[d] = (root, rule, pruned)
+        return cached
+
+    def classify(self, path):
+        # (task, state, alert, forward) for an interesting file, otherwise None
+        d, sep, name = path.rpartition(os.sep)
+        dot = name.rfind('.')
+        if dot <= 0:
+            return None
+        root, rule, pruned = self.rule(d)
+        if rule is None or pruned:
+            return None
+        compressed = name[dot + 1:].lower() in RetentionService.CODECS
+        if compressed:
+            # a log compressed by retention keeps its task and state but is never alerted or forwarded again
+            name = name[:dot]
+            dot = name.rfind('.')
+            if dot <= 0:
+                return None
+        flags = rule.exts.get(name[dot + 1:].lower())
+        if flags is None:
+            return None
+        if compressed:
+            flags = (flags[0], False, False)
+        if rule.include is not None or rule.exclude is not None:
+            rel = path[len(root) + 1:]
+            if rule.include is not None and not rule.include.match(rel):
+                return None
+            if rule.exclude is not None and rule.exclude.match(rel):
+                return None
+        return (rule.task(name[:dot]),) + flags
+
+    def prune(self, d):
+        return self.rule(d)[2]
+
+    def diff(self, old):
+        # directories whose rules changed, without the ones nested in another changed directory
+        if old is None:
+            return list(self.log_dirs)
+        changed = sorted(d for d in set(self.specs) | set(old.specs) if self.specs.get(d) != old.specs.get(d))
+        result = []
+        for d in changed:
+            if not any(d.startswith(parent + os.sep) for parent in result):
+                result.append(d)
+        return result
+
+
+class ScanEngine:
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def shards(self, rules, dirs=None):
+        # split each log dir into (dir, recursive) subtrees until there is enough work for every worker
+        shards = [(d, True) for d in (rules.log_dirs if dirs is None else dirs)]
+        for level in range(3):
+            if len(shards) >= self.workers * 4:
+                break
+            expanded = []
+            for d, recursive in shards:
+                if not recursive:
+                    expanded.append((d, False))
+                    continue
+                expanded.append((d, False))
+                try:
+                    with os.scandir(d) as it:
+                        expanded.extend((entry.path, True) for entry in it if entry.is_dir(follow_symlinks=False) and not rules.prune(entry.path))
+                except OSError:
+                    continue
+            shards = expanded
+        return shards
+
+    def map(self, func, shards, *args, cancel=None):
+        workers = min(self.workers, len(shards))
+        if workers <= 1:
+            for shard in shards:
+                if cancel is not None and cancel.is_set():
+                    raise concurrent.futures.CancelledError('scan cancelled')
+                yield func(shard, *args)
+            return
+        # one pool per scan: idle workers would each keep an interpreter resident between scans
+        # spawn: the client forks from a process that already runs threads
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        with self.lock:
+            self.pool = executor
+        futures = [executor.submit(func, shard, *args) for shard in shards]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if cancel is not None and cancel.is_set():
+                    raise concurrent.futures.CancelledError('scan cancelled')
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            with self.lock:
+                if self.pool is executor:
+                    self.pool = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def walk(shard, rules):
+        d, recursive = shard
+        stack = [d]
+        while stack:
+            d = stack.pop()
+            try:
+                st = os.stat(d)
+                with os.scandir(d) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            subdirs = []
+            files = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not rules.prune(entry.path):
+                            subdirs.append(entry.path)
+                    else:
+                        files.append(entry)
+                except OSError:
+                    continue
+            yield d, st, subdirs, files
+            if recursive:
+                stack.extend(subdirs)
+
+    @staticmethod
+    def scan_shard(shard, rules, now):
+        # newest report file per task, the caller only reads the winners
+        tasks = {}
+        for d, st, subdirs, files in ScanEngine.walk(shard, rules):
+            for entry in files:
+                classified = rules.classify(entry.path)
+                if classified is None or classified[1] is None:
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if now - mtime >= 24 * 3600:
+                    continue
+                task = classified[0]
+                if task not in tasks or tasks[task][0] < mtime:
+                    tasks[task] = (mtime, entry.path)
+        return tasks
+
+    @staticmethod
+    def index_shard(shard, rules):
+        # directory listing cache and file stats in the shape PollingWatcher keeps
+        dirs = {}
+        files = {}
+        for d, st, subdirs, entries in ScanEngine.walk(shard, rules):
+            names = [entry.path for entry in entries if rules.classify(entry.path) is not None]
+            dirs[d] = (st.st_mtime_ns, subdirs, names)
+            for path in names:
+                try:
+                    file_st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (file_st.st_mtime_ns, file_st.st_size)
+        return dirs, files
+
+    def scan_tasks(self, rules, cancel=None):
+        tasks = {}
+        for shard_tasks in self.map(self.scan_shard, self.shards(rules), rules, time.time(), cancel=cancel):
+            for task, result in shard_tasks.items():
+                if task not in tasks or tasks[task][0] < result[0]:
+                    tasks[task] = result
+        return tasks
+
+    def index(self, rules):
+        dirs = {}
+        files = {}
+        for shard_dirs, shard_files in self.map(self.index_shard, self.shards(rules), rules):
+            dirs.update(shard_dirs)
+            files.update(shard_files)
+        return dirs, files
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+
+class PollingWatcher:
+
+    def __init__(self, rules, interval=5, executor=None, engine=None):
+        self.rules = rules
+        self.log_dirs = rules.log_dirs
+        self.interval = interval
+        self.executor = executor
+        self.engine = engine
+        self.dirs = {}
+        self.files = {}
+        self.last_scan_time = 0
+
+    def scan(self):
+        if not self.dirs and self.engine is not None:
+            self.dirs, self.files = self.engine.index(self.rules)
+            return set(self.files)
+        changed = set()
+        dirs = {}
+        files = {}
+        stack = list(self.log_dirs)
+        while stack:
+            d = stack.pop()
+            try:
+                st = os.stat(d)
+            except OSError:
+                continue
+            cached = self.dirs.get(d)
+            if cached is None or cached[0] != st.st_mtime_ns:
+                subdirs = []
+                names = []
+                try:
+                    with os.scandir(d) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not self.rules.prune(entry.path):
+                                    subdirs.append(entry.path)
+                            elif self.rules.classify(entry.path) is not None:
+                                names.append(entry.path)
+                except OSError:
+                    continue
+                cached = (st.st_mtime_ns, subdirs, names)
+            dirs[d] = cached
+            stack.extend(cached[1])
+            for path in cached[2]:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_mtime_ns, st.st_size)
+                if self.files.get(path) != files[path]:
+                    changed.add(path)
+        # removed files are reported too, so their state is dropped
+        changed.update(path for path in self.files if path not in files)
+        self.dirs = dirs
+        self.files = files
+        return changed
+
+    async def changes(self, timeout):
+        await asyncio.sleep(max(0, min(timeout, self.last_scan_time + self.interval - time.time())))
+        self.last_scan_time = time.time()
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.scan)
+
+    def update(self, rules, changed):
+        # forget the listings under changed directories so the next scan reports their files again
+        under = lambda path: any(path == d or path.startswith(d + os.sep) for d in changed)
+        self.dirs = {d: cached for d, cached in self.dirs.items() if not under(d)}
+        self.files = {path: cached for path, cached in self.files.items() if not under(path)}
+        self.rules = rules
+        self.log_dirs = rules.log_dirs
+
+    def close(self):
+        self.dirs = {}
+        self.files = {}
+
+
+class InotifyWatcher:
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, rules, settle=0.5, executor=None):
+        self.rules = rules
+        self.log_dirs = rules.log_dirs
+        self.settle = settle
+        self.executor = executor
+        self.wds = {}
+        self.changed = set()
+        # trees to walk, found on the loop thread and walked in the executor by changes()
+        self.new_dirs = set()
+        self.rescan = False
+        # created on the loop thread in changes(), __init__ and add_tree may run in a worker thread
+        self.event = None
+        self.reading = False
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        try:
+            for log_dir in self.log_dirs:
+                self.add_tree(log_dir)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, root):
+        wds, paths = self.walk_tree(root)
+        self.wds.update(wds)
+        self.changed.update(paths)
+
+    def walk_tree(self, root):
+        # only returns what it found, so it can run off the loop thread
+        wds = {}
+        paths = set()
+        for d, subdirs, names in os.walk(root):
+            subdirs[:] = [name for name in subdirs if not self.rules.prune(os.path.join(d, name))]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), self.WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:  # ENOSPC: fs.inotify.max_user_watches reached
+                    raise OSError(errno, 'inotify watch limit reached')
+                continue
+            wds[wd] = d
+            for name in names:
+                path = os.path.join(d, name)
+                if self.rules.classify(path) is not None:
+                    paths.add(path)
+        return wds, paths
+
+    def walk_trees(self, roots):
+        results = []
+        for root in roots:
+            try:
+                results.append(self.walk_tree(root))
+            except OSError as e:
+                print(e, file=sys.stderr)
+        return results
+
+    async def add_pending(self):
+        if not self.rescan and not self.new_dirs:
+            return
+        # an overflowed queue lost events anywhere, so every log dir is walked again
+        roots = list(self.log_dirs) if self.rescan else sorted(self.new_dirs)
+        self.rescan = False
+        self.new_dirs = set()
+        for wds, paths in await asyncio.get_event_loop().run_in_executor(self.executor, self.walk_trees, roots):
+            self.wds.update(wds)
+            self.changed.update(paths)
+
+    def on_readable(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.rescan = True
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.wds.pop(wd, None)
+                    continue
+                parent = self.wds.get(wd)
+                if parent is None or not name:
+                    continue
+                path = os.path.join(parent, name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_DELETE | self.IN_MOVED_FROM) or self.rules.prune(path):
+                        continue
+                    self.new_dirs.add(path)
+                elif self.rules.classify(path) is not None:
+                    self.changed.add(path)
+        if self.changed or self.new_dirs or self.rescan:
+            self.event.set()
+
+    async def changes(self, timeout):
+        if not self.reading:
+            # the initial walk may run in a worker thread, so only hook the loop here
+            self.event = asyncio.Event()
+            asyncio.get_event_loop().add_reader(self.fd, self.on_readable)
+            self.reading = True
+        if not self.changed and not self.new_dirs and not self.rescan:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        deadline = time.time() + self.settle * 10
+        while True:
+            await self.add_pending()
+            if not self.changed or time.time() >= deadline:
+                break
+            # let writers finish before the files are read
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), self.settle)
+            except asyncio.TimeoutError:
+                break
+        self.event.clear()
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def update(self, rules, changed):
+        # runs on the loop thread like on_readable, the changed trees are walked by changes()
+        under = lambda path, dirs: any(path == d or path.startswith(d + os.sep) for d in dirs)
+        for wd, d in list(self.wds.items()):
+            if not under(d, rules.log_dirs) or rules.prune(d):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.wds.pop(wd, None)
+        self.new_dirs.update(d for d in changed if under(d, rules.log_dirs))
+        self.rules = rules
+        self.log_dirs = rules.log_dirs
+
+    def close(self):
+        if self.reading:
+            asyncio.get_event_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+
+class Channel:
+
+    # seq, id, reply_to, type length, json length; followed by type, json, blob and the MAC
+    HEADER = struct.Struct('!QIIBI')
+    MAC_SIZE = 16
+
+    def __init__(self, olog, websocket, handler=None):
+        self.olog = olog
+        self.websocket = websocket
+        self.handler = handler
+        self.next_id = 0
+        self.waiters = {}
+        self.tasks = set()
+        self.mac = None
+        self.send_seq = 0
+        self.recv_seq = 0
+        self.last_seen = time.monotonic()
+        self.expired = False
+
+    def sign(self, label, device, client_nonce, server_nonce):
+        msg = '\n'.join([label, device, client_nonce, server_nonce]).encode('utf-8')
+        return hmac.new(self.olog.olog_cfg['token'].encode('utf-8'), msg, hashlib.sha256).hexdigest()
+
+    def set_key(self, key):
+        self.mac = hmac.new(key, digestmod=hashlib.sha256)
+        self.send_seq = 0
+        self.recv_seq = 0
+
+    async def login(self, device):
+        client_nonce = secrets.token_hex(16)
+        await self.websocket.send(json.dumps({'device': device, 'nonce': client_nonce}))
+        hello = json.loads(await self.websocket.recv())
+        server_nonce = hello['nonce']
+        if not hmac.compare_digest(hello['proof'], self.sign('server', device, client_nonce, server_nonce)):
+            raise PermissionError('[ERROR] server failed to prove the token')
+        await self.websocket.send(json.dumps({'proof': self.sign('client', device, client_nonce, server_nonce)}))
+        self.set_key(bytes.fromhex(self.sign('session', device, client_nonce, server_nonce)))
+
+    async def accept(self):
+        hello = json.loads(await self.websocket.recv())
+        device, client_nonce = hello['device'], hello['nonce']
+        server_nonce = secrets.token_hex(16)
+        await self.websocket.send(json.dumps({'nonce': server_nonce, 'proof': self.sign('server', device, client_nonce, server_nonce)}))
+        reply = json.loads(await self.websocket.recv())
+        if not hmac.compare_digest(reply['proof'], self.sign('client', device, client_nonce, server_nonce)):
+            raise PermissionError(f'[ERROR] {device} failed to prove the token')
+        self.set_key(bytes.fromhex(self.sign('session', device, client_nonce, server_nonce)))
+        return device
+
+    def pack(self, type_, data, id_, reply_to=None, blob=b''):
+        self.send_seq += 1
+        type_ = type_.encode('utf-8')
+        meta = json.dumps(data, separators=(',', ':')).encode('utf-8') if data is not None else b''
+        frame = self.HEADER.pack(self.send_seq, id_, reply_to or 0, len(type_), len(meta)) + type_ + meta + blob
+        mac = self.mac.copy()
+        mac.update(frame)
+        return frame + mac.digest()[:self.MAC_SIZE]
+
+    def unpack(self, frame):
+        frame, tag = frame[:-self.MAC_SIZE], frame[-self.MAC_SIZE:]
+        mac = self.mac.copy()
+        mac.update(frame)
+        if not hmac.compare_digest(tag, mac.digest()[:self.MAC_SIZE]):
+            raise PermissionError('[ERROR] frame MAC mismatch')
+        seq, id_, reply_to, type_size, meta_size = self.HEADER.unpack_from(frame)
+        # frames arrive in order on one websocket, so any gap is a replay or a forgery
+        if seq != self.recv_seq + 1:
+            raise PermissionError(f'[ERROR] frame sequence {seq} out of order')
+        self.recv_seq = seq
+        start = self.HEADER.size
+        type_ = frame[start:start + type_size].decode('utf-8')
+        start += type_size
+        meta = frame[start:start + meta_size]
+        data = json.loads(meta) if meta else None
+        return {'id': id_, 'reply_to': reply_to or None, 'type': type_, 'data': data, 'blob': frame[start + meta_size:]}
+
+    async def send(self, type_, data=None, reply_to=None, blob=b''):
+        self.next_id += 1
+        await self.websocket.send(self.pack(type_, data, self.next_id, reply_to, blob))
+        return self.next_id
+
+    async def request(self, type_, data=None, timeout=30, blob=b''):
+        id_ = self.next_id + 1
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[id_] = future
+        try:
+            await self.send(type_, data, blob=blob)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters.pop(id_, None)
+
+    async def dispatch(self, msg):
+        try:
+            result = await self.handler(self, msg['type'], msg['data'], msg['blob'])
+            if result is not None:
+                await self.send('reply', result, msg['id'])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(e, file=sys.stderr)
+
+    async def serve(self):
+        # reads every inbound message so replies and requests can interleave freely
+        try:
+            async for recv in self.websocket:
+                self.last_seen = time.monotonic()
+                try:
+                    msg = self.unpack(recv)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                    await self.websocket.close()
+                    break
+                future = self.waiters.get(msg.get('reply_to'))
+                if future is not None:
+                    if not future.done():
+                        future.set_result(msg.get('data'))
+                elif self.handler is not None:
+                    task = asyncio.ensure_future(self.dispatch(msg))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+        finally:
+            for future in self.waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('channel closed'))
+            for task in list(self.tasks):
+                task.cancel()
+
+
+class HeartbeatScheduler:
+
+    def __init__(self, olog, on_expire):
+        self.olog = olog
+        self.on_expire = on_expire
+        self.heap = []
+        self.channels = {}
+        self.tokens = itertools.count()
+        self.wakeup = None
+
+    def cfg(self, key, default):
+        return self.olog.olog_cfg.get(key, default)
+
+    def register(self, channel, device):
+        token = next(self.tokens)
+        channel.last_seen = time.monotonic()
+        self.channels[token] = (channel, device)
+        heapq.heappush(self.heap, (channel.last_seen + self.cfg('heartbeat_interval', 5), token))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return token
+
+    def unregister(self, token):
+        self.channels.pop(token, None)
+
+    async def ping(self, channel, device):
+        start = time.perf_counter()
+        try:
+            pong = await channel.websocket.ping()
+            await asyncio.wait_for(pong, self.cfg('offline_grace', 30))
+        except Exception:
+            return
+        rtt = time.perf_counter() - start
+        channel.last_seen = time.monotonic()
+        self.olog.metrics.observe('olog_heartbeat_rtt_seconds', rtt)
+        self.olog.metrics.set('olog_device_rtt_seconds', rtt, device=device.split('#')[0])
+
+    def check(self, token, now):
+        # returns the next deadline of a live channel, None once it expired
+        channel, device = self.channels[token]
+        interval = self.cfg('heartbeat_interval', 5)
+        grace = self.cfg('offline_grace', 30)
+        idle = now - channel.last_seen
+        if idle >= grace:
+            del self.channels[token]
+            self.olog.metrics.inc('olog_heartbeat_expired_total')
+            self.on_expire(channel, device)
+            return None
+        if idle < interval:
+            return channel.last_seen + interval
+        # only idle channels are pinged, inbound traffic already proves liveness
+        asyncio.ensure_future(self.ping(channel, device))
+        return min(now + interval, channel.last_seen + grace)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, token = heapq.heappop(self.heap)
+                if token not in self.channels:
+                    continue
+                try:
+                    deadline = self.check(token, now)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                    deadline = now + self.cfg('heartbeat_interval', 5)
+                if deadline is not None:
+                    heapq.heappush(self.heap, (deadline, token))
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class FileStateStore:
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.is_new = not self.path.exists()
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(files)')]
+            if columns and 'path' not in columns:
+                # rows keyed by (dev, ino) alone are not trusted, start over as on a first run
+                self.conn.execute('DROP TABLE files')
+                self.conn.execute('DROP TABLE IF EXISTS offsets')
+                self.is_new = True
+            # keyed by path like the in-memory state was, (dev, ino) tells a replaced file from the old one
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, alert_time REAL) WITHOUT ROWID''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                task TEXT PRIMARY KEY, alert_time REAL) WITHOUT ROWID''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS offsets (
+                path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, offset INTEGER) WITHOUT ROWID''')
+            self.conn.commit()
+        return self.conn
+
+    def get(self, path, st):
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT dev, ino, size, mtime_ns, alert_time FROM files WHERE path = ?', (path, )).fetchone()
+        # another file at this path is a new file
+        if row is None or row[0] != st.st_dev or row[1] != st.st_ino:
+            return None
+        return row[2:]
+
+    def put(self, path, st, alert_time=None):
+        with self.lock:
+            self.connect().execute(
+                '''INSERT INTO files (path, dev, ino, size, mtime_ns, alert_time) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns,
+                alert_time = CASE WHEN files.dev = excluded.dev AND files.ino = excluded.ino
+                THEN COALESCE(excluded.alert_time, files.alert_time) ELSE excluded.alert_time END,
+                dev = excluded.dev, ino = excluded.ino''',
+                (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, alert_time))
+
+    def task_alert_time(self, task):
+        with self.lock:
+            row = self.connect().execute('SELECT alert_time FROM tasks WHERE task = ?', (task, )).fetchone()
+        return row[0] if row else 0
+
+    def set_task_alert_time(self, task, alert_time):
+        with self.lock:
+            self.connect().execute('INSERT OR REPLACE INTO tasks (task, alert_time) VALUES (?, ?)', (task, alert_time))
+
+    def get_offset(self, path, st):
+        with self.lock:
+            row = self.connect().execute('SELECT dev, ino, offset FROM offsets WHERE path = ?', (path, )).fetchone()
+        if row is None or row[0] != st.st_dev or row[1] != st.st_ino:
+            return None
+        return row[2]
+
+    def set_offset(self, path, st, offset):
+        with self.lock:
+            self.connect().execute('INSERT OR REPLACE INTO offsets (path, dev, ino, offset) VALUES (?, ?, ?, ?)', (path, st.st_dev, st.st_ino, offset))
+
+    def forget(self, path):
+        with self.lock:
+            self.connect().execute('DELETE FROM files WHERE path = ?', (path, ))
+            self.connect().execute('DELETE FROM offsets WHERE path = ?', (path, ))
+
+    def prune(self):
+        # files removed while the client was not running
+        with self.lock:
+            paths = [row[0] for row in self.connect().execute('SELECT path FROM files UNION SELECT path FROM offsets')]
+        for path in paths:
+            if not os.path.exists(path):
+                self.forget(path)
+        self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
+
+
+class HistoryStore:
+
+    STATES = ['ok', 'err', 'lost']
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.conn = None
+        self.ids = {}
+        self.rows = []
+
+    def connect(self):
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path))
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, kind INTEGER, name TEXT, UNIQUE (kind, name))')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS history (
+                device INTEGER, task INTEGER, logdate INTEGER, state INTEGER, received INTEGER, detail TEXT,
+                PRIMARY KEY (device, task, logdate, state)) WITHOUT ROWID''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_logdate ON history (logdate)')
+            self.conn.commit()
+        return self.conn
+
+    def name_id(self, kind, name):
+        # kind 0 is a device, 1 is a task
+        key = (kind, name)
+        if key not in self.ids:
+            conn = self.connect()
+            conn.execute('INSERT OR IGNORE INTO names (kind, name) VALUES (?, ?)', key)
+            self.ids[key] = conn.execute('SELECT id FROM names WHERE kind = ? AND name = ?', key).fetchone()[0]
+        return self.ids[key]
+
+    def append(self, device, tasks):
+        received = int(time.time())
+        for task, info in tasks.items():
+            try:
+                logdate = int(datetime.datetime.strptime(info['logdate'], '%Y-%m-%d %H:%M:%S').timestamp())
+            except (KeyError, ValueError):
+                continue
+            state = self.STATES.index(info['state']) if info.get('state') in self.STATES else 1
+            self.rows.append((self.name_id(0, device), self.name_id(1, task), logdate, state, received, info.get('detail', '')))
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        conn = self.connect()
+        # snapshots resent after a reconnect hit the primary key and are ignored
+        conn.executemany('INSERT OR IGNORE INTO history VALUES (?, ?, ?, ?, ?, ?)', rows)
+        conn.commit()
+
+    def match_ids(self, kind, name):
+        conn = self.connect()
+        if name is None:
+            return None
+        # a plain prefix compare: LIKE would treat _ and % as wildcards and ignore case
+        rows = conn.execute('SELECT id FROM names WHERE kind = ? AND (name = ? OR substr(name, 1, ?) = ?)', (kind, name, len(name) + 1, f'{name}#')).fetchall()
+        return [row[0] for row in rows]
+
+    def where(self, device, task, since, until):
+        clauses = ['logdate >= ?', 'logdate < ?']
+        args = [int(since.timestamp()), int(until.timestamp())]
+        for column, kind, name in [('device', 0, device), ('task', 1, task)]:
+            ids = self.match_ids(kind, name)
+            if ids is not None:
+                clauses.append(f'{column} IN ({",".join("?" * len(ids)) or "NULL"})')
+                args.extend(ids)
+        return ' AND '.join(clauses), args
+
+    def query(self, device=None, task=None, since=None, until=None, limit=1000):
+        self.flush()
+        where, args = self.where(device, task, since, until)
+        rows = self.connect().execute(f'''SELECT d.name, t.name, h.logdate, h.state, h.detail FROM history h
+            JOIN names d ON d.id = h.device JOIN names t ON t.id = h.task
+            WHERE {where} ORDER BY h.logdate DESC LIMIT ?''', args + [limit]).fetchall()
+        return [{
+            'device': row[0],
+            'task': row[1],
+            'logdate': datetime.datetime.fromtimestamp(row[2]).strftime('%Y-%m-%d %H:%M:%S'),
+            'state': self.STATES[row[3]],
+            'detail': row[4]
+        } for row in rows]
+
+    def stats(self, device=None, task=None, since=None, until=None):
+        self.flush()
+        where, args = self.where(device, task, since, until)
+        rows = self.connect().execute(f'''SELECT d.name, t.name, h.runs, h.errs, h.last FROM (
+                SELECT device, task, COUNT(*) AS runs, SUM(state != 0) AS errs, MAX(logdate) AS last
+                FROM history WHERE {where} GROUP BY device, task) h
+            JOIN names d ON d.id = h.device JOIN names t ON t.id = h.task
+            ORDER BY h.errs * 1.0 / h.runs DESC, d.name, t.name''', args).fetchall()
+        return [{
+            'device': row[0],
+            'task': row[1],
+            'runs': row[2],
+            'errs': row[3],
+            'failure_rate': round(row[3] / row[2], 4),
+            'last': datetime.datetime.fromtimestamp(row[4]).strftime('%Y-%m-%d %H:%M:%S')
+        } for row in rows]
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+
+class RetentionService:
+
+    CODECS = {'gz': 'gzip', 'zst': 'zstd'}
+
+    def __init__(self, olog, path, executor=None):
+        self.olog = olog
+        self.path = pathlib.Path(path)
+        self.executor = executor
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def cfg(self, key, default):
+        return self.olog.olog_cfg.get(key, default)
+
+    def connect(self):
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS ages (
+                path TEXT PRIMARY KEY, policy TEXT, mtime REAL, compressed INTEGER) WITHOUT ROWID''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS ages_mtime ON ages (policy, compressed, mtime)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS seeded (policy TEXT PRIMARY KEY, time REAL) WITHOUT ROWID')
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def compressed(path):
+        return os.path.splitext(path)[1].lower()[1:] in RetentionService.CODECS
+
+    @staticmethod
+    def open(p):
+        ext = os.path.splitext(str(p))[1].lower()[1:]
+        if ext == 'gz':
+            return gzip.open(p, 'rb')
+        if ext == 'zst':
+            if zstandard is None:
+                raise ImportError(f'zstandard is required to read {p}')
+            return zstandard.ZstdDecompressor().stream_reader(open(p, 'rb'), closefd=True)
+        return open(p, 'rb')
+
+    def track(self, path, mtime, policy):
+        with self.lock:
+            self.connect().execute(
+                '''INSERT INTO ages (path, policy, mtime, compressed) VALUES (?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET policy = excluded.policy, mtime = excluded.mtime''',
+                (str(path), policy, mtime, int(self.compressed(str(path)))))
+
+    def forget(self, path):
+        with self.lock:
+            self.connect().execute('DELETE FROM ages WHERE path = ?', (str(path), ))
+
+    def commit(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+
+    def seed(self, policy, root, pattern):
+        # one walk per policy, afterwards files are tracked as they are written; the index file may be shared by several roles
+        with self.lock:
+            if self.connect().execute('SELECT 1 FROM seeded WHERE policy = ?', (policy, )).fetchone():
+                return
+        for p in pathlib.Path(root).glob(pattern):
+            try:
+                self.track(p, p.stat().st_mtime, policy)
+            except OSError:
+                continue
+        with self.lock:
+            self.connect().execute('INSERT OR REPLACE INTO seeded (policy, time) VALUES (?, ?)', (policy, time.time()))
+        self.commit()
+
+    def expired(self, policy, before, compressed, limit):
+        sql = 'SELECT path, mtime FROM ages WHERE policy = ? AND mtime < ?'
+        args = [policy, before]
+        if compressed is not None:
+            sql += ' AND compressed = ?'
+            args.append(int(compressed))
+        with self.lock:
+            return self.connect().execute(sql + ' ORDER BY mtime LIMIT ?', args + [limit]).fetchall()
+
+    def current(self, path, mtime, policy):
+        # the index may be stale: a rewritten file starts aging again, a vanished one is dropped
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.forget(path)
+            return None
+        if st.st_mtime != mtime:
+            self.track(path, st.st_mtime, policy)
+            return None
+        return st
+
+    def compress(self, path, st, codec):
+        if codec == 'zstd' and zstandard is None:
+            print('[WARNING] zstandard is not installed, compressing with gzip', file=sys.stderr)
+            codec = 'gzip'
+        target = f'{path}.{"zst" if codec == "zstd" else "gz"}'
+        tmp = target + '.tmp'
+        with open(path, 'rb') as fr:
+            if codec == 'zstd':
+                with open(tmp, 'wb') as fw:
+                    zstandard.ZstdCompressor().copy_stream(fr, fw)
+            else:
+                with gzip.open(tmp, 'wb') as fw:
+                    shutil.copyfileobj(fr, fw)
+        # keep the original mtime so the compressed file ages on the same clock
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, target)
+        os.remove(path)
+        return target
+
+    def sweep(self, policies):
+        # policies: name -> (keep_days, compress_days or None, codec); at most retention_batch files per sweep
+        budget = self.cfg('retention_batch', 200)
+        delay = 1 / self.cfg('retention_rate', 20)
+        now = time.time()
+        for policy, (keep_days, compress_days, codec) in policies.items():
+            for path, mtime in self.expired(policy, now - keep_days * 24 * 3600, None, budget):
+                try:
+                    if self.current(path, mtime, policy) is None:
+                        continue
+                    os.remove(path)
+                    self.forget(path)
+                    self.olog.metrics.inc('olog_retention_deleted_total', policy=policy)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                budget -= 1
+                time.sleep(delay)
+            if compress_days is None or budget <= 0:
+                continue
+            for path, mtime in self.expired(policy, now - compress_days * 24 * 3600, False, budget):
+                try:
+                    st = self.current(path, mtime, policy)
+                    if st is None:
+                        continue
+                    target = self.compress(path, st, codec)
+                    self.forget(path)
+                    self.track(target, st.st_mtime, policy)
+                    self.olog.metrics.inc('olog_retention_compressed_total', policy=policy)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                budget -= 1
+                time.sleep(delay)
+        self.commit()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.cfg('retention_interval', 60))
+                policies = await asyncio.get_event_loop().run_in_executor(self.executor, self.olog.retention_policies)
+                if policies:
+                    await asyncio.get_event_loop().run_in_executor(self.executor, self.sweep, policies)
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+
 class OlogClient(Olog):
 
-    def __init__(self):
-        super().__init__()
-        self.log_monitor = {}
-        self.watch_sent_time = {}
-        for log_dir in self.olog_cfg['log_dirs']:
-            log_dir = pathlib.Path(log_dir)
-            for p in log_dir.glob('**/*'):
-                self.log_monitor[str(p.resolve())] = {
-                    'size': p.stat().st_size,
-                    'mtime': p.stat().st_mtime
-                }
+    def __init__(self, olog_cfg_path=None):
+        super().__init__(olog_cfg_path)
+        state_path = self.olog_cfg.get('state_path') or pathlib.Path(__file__).parent / 'olog_client.db'
+        self.state = FileStateStore(state_path)
+        self.summarizer = LogSummarizer()
+        self.start_time = time.time()
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.olog_cfg.get('io_workers', 4), thread_name_prefix='olog-io')
+        self.scanner = ScanEngine(self.olog_cfg.get('scan_workers'))
+        self.retention = RetentionService(self, self.olog_cfg.get('retention_path') or pathlib.Path(__file__).parent / 'olog_retention.db', self.pool)
+        self.rules = None
+        self.rules_key = None
+        self.task_states = {}
+        self.channel = None
+        self.forward_pending = set()
+        self.unsent_deltas = {}
 
     def run(self):
         print('[BEGIN] running as client...')
         self.sendmsg(f'{self.device} running as client...', f'{self.device} running as client...\n\n---\n\n{self.addr}', 3)
         while True:
             try:
-                asyncio.get_event_loop().run_until_complete(asyncio.gather(self.client(), self.watch(), self.wechat_send()))
+                asyncio.get_event_loop().run_until_complete(asyncio.gather(self.client(), self.watch(), self.forward(), self.retention.run(), self.dispatcher.run(), self.serve_metrics()))
                 asyncio.get_event_loop().run_forever()
             except Exception as e:
                 print(e, file=sys.stderr)
                 time.sleep(10)
 
+    def forward_exts(self):
+        if not self.olog_cfg.get('forward'):
+            return []
+        return self.olog_cfg.get('forward_exts', ['log', 'err', 'scanerr', 'msg'])
+
+    def retention_policies(self):
+        return {'log': (self.olog_cfg['log_keep_days'], self.olog_cfg.get('log_compress_days'), self.olog_cfg.get('log_compress', 'gzip'))}
+
+    def watch_rules(self):
+        # recompiled only when the parts of the config they depend on change
+        key = json.dumps([self.olog_cfg['log_dirs'], self.olog_cfg.get('watch_rules'), self.forward_exts()], sort_keys=True)
+        if key != self.rules_key:
+            try:
+                self.rules = WatchRules(self.olog_cfg['log_dirs'], self.olog_cfg.get('watch_rules'), self.forward_exts())
+            except (ValueError, re.error) as e:
+                if self.rules is None:
+                    raise
+                print(f'[WARNING] invalid watch_rules, keep the previous rules: {e}', file=sys.stderr)
+            self.rules_key = key
+        return self.rules
+
+    def new_watcher(self, rules):
+        backend = self.olog_cfg.get('watch_backend', 'auto')
+        if backend in ['auto', 'inotify'] and sys.platform.startswith('linux'):
+            try:
+                return InotifyWatcher(rules, executor=self.pool)
+            except Exception as e:
+                print(f'[WARNING] inotify watcher unavailable, fallback to polling: {e}', file=sys.stderr)
+        return PollingWatcher(rules, self.olog_cfg.get('watch_interval', 5), self.pool, self.scanner)
+
+    async def run_blocking(self, func, *args, timeout=None, cancel=None):
+        # runs filesystem work in the io pool so the event loop only serves network I/O
+        future = asyncio.get_event_loop().run_in_executor(self.pool, functools.partial(func, *args))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if cancel is not None:
+                cancel.set()
+            raise
+
+    def check_alerts(self, paths):
+        pending = set()
+        deltas = {}
+        rules = self.watch_rules()
+        for path in sorted(paths):
+            classified = rules.classify(path)
+            if classified is None:
+                continue
+            p = pathlib.Path(path)
+            if classified[1] is not None:
+                try:
+                    self.retention.track(path, os.stat(path).st_mtime, 'log')
+                except FileNotFoundError:
+                    self.retention.forget(path)
+                try:
+                    result = self.log_task(p)
+                except FileNotFoundError:
+                    result = None
+                # a task may have several files, the newest one decides its state like in scan_logs
+                if result is not None and self.newer(result[1], deltas.get(result[0])) and self.newer(result[1], self.task_states.get(result[0])):
+                    deltas[result[0]] = result[1]
+            if classified[2] and self.check_alert(p):
+                pending.add(path)
+        deltas = {task: info for task, info in deltas.items() if self.task_states.get(task) != info}
+        self.task_states.update(deltas)
+        self.state.commit()
+        self.retention.commit()
+        return pending, deltas
+
     async def watch(self):
+        watcher = None
+        pending = set()
         while True:
             try:
                 self.read_olog_config()
-                for log_dir in self.olog_cfg['log_dirs']:
-                    log_dir = pathlib.Path(log_dir)
-                    for p in log_dir.glob('**/*'):
-                        ext = p.suffix.lower()[1:] 
-                        task = re.findall('@(.*?)@', p.stem)
-                        if len(task) > 0:
-                            task = task[0]
-                        else:
-                            task = p.stem
-                        if ext not in self.watch_exts:
-                            continue
-                        if str(p.resolve()) in self.log_monitor.keys() and \
-                            self.log_monitor[str(p.resolve())]['mtime'] == p.stat().st_mtime and \
-                            self.log_monitor[str(p.resolve())]['size'] == p.stat().st_size:
-                            continue
-                        elif time.time() - self.watch_sent_time.get(str(p.resolve()), 0) > 24 * 3600 and \
-                                time.time() - p.stat().st_mtime < 3600 and \
-                                    time.time() - self.watch_sent_time.get(task, 0) > 600:
-                            await asyncio.sleep(10)
-                            with p.open('r', encoding='utf-8') as fr:
-                                log_detail = fr.read().strip()
-                            if not log_detail:
-                                continue
-                            if len(log_detail) > 1050:
-                                log_detail = log_detail[:500] + '...\n......\n...' + log_detail[-500:]
-                            log_date = datetime.datetime.fromtimestamp(p.stat().st_mtime)
-                            title = f'{ext.upper()}: {self.device} @ {task}'
-                            report = f'''## log info
+                rules = self.watch_rules()
+                if watcher is None:
+                    await self.run_blocking(self.state.prune)
+                    watcher = await self.run_blocking(self.new_watcher, rules)
+                elif watcher.rules is not rules:
+                    # a config reload only rescans the directories whose rules changed
+                    changed_dirs = rules.diff(watcher.rules)
+                    print(f'[NOTICE] watch rules changed, rescanning {changed_dirs}')
+                    # on the loop thread: the inotify callback changes the same watch table
+                    watcher.update(rules, changed_dirs)
+                changed = await watcher.changes(5)
+                start = time.perf_counter()
+                pending.update(changed)
+                for path in changed:
+                    classified = rules.classify(path)
+                    if classified is not None and classified[3]:
+                        self.forward_pending.add(path)
+                self.metrics.inc('olog_watch_files_examined_total', len(pending))
+                self.metrics.set('olog_watch_files_last_cycle', len(pending))
+                pending, deltas = await self.run_blocking(self.check_alerts, pending, timeout=self.olog_cfg.get('io_timeout', 600))
+                self.metrics.observe('olog_watch_cycle_seconds', time.perf_counter() - start)
+                if deltas and self.channel is not None:
+                    await self.channel.send('state', {'full': False, 'tasks': deltas})
+                elif deltas:
+                    # no connection or a snapshot in progress, client() sends these after the snapshot
+                    self.unsent_deltas.update(deltas)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                await asyncio.sleep(5)
+
+    @staticmethod
+    def newer(info, current):
+        return current is None or info['logdate'] >= current['logdate']
+
+    def check_alert(self, p):
+        # returns True when the file changed but may still be alerted later
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            self.state.forget(str(p))
+            return False
+        ext = p.suffix.lower()[1:]
+        task = self.task_name(p)
+        path = str(p.resolve())
+        record = self.state.get(str(p), st)
+        if record is None and self.state.is_new and st.st_mtime < self.start_time:
+            # first run: remember existing files instead of alerting on all of them
+            self.state.put(str(p), st)
+            return False
+        if record is not None and record[0] == st.st_size and record[1] == st.st_mtime_ns:
+            return False
+        alert_time = (record[2] or 0) if record is not None else 0
+        if time.time() - alert_time <= 24 * 3600 or time.time() - st.st_mtime >= 3600:
+            self.state.put(str(p), st)
+            return False
+        if time.time() - self.state.task_alert_time(task) <= 600:
+            return True
+        log_detail = self.summarizer.summary(p, st, 500, 1050, strip=True)
+        if not log_detail:
+            return True
+        log_date = datetime.datetime.fromtimestamp(st.st_mtime)
+        title = f'{ext.upper()}: {self.device} @ {task}'
+        report = f'''## log info
 
 device: {self.device}
 task: {task}
 addr: {self.addr}
-log path: {p.resolve()}
+log path: {path}
 log time: {log_date.strftime("%Y-%m-%d %H:%M:%S")}
 report time: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
@@ -189,48 +1765,48 @@ report time: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 ## log detail
 {log_detail}
 '''
-                            self.sendmsg(title, report, 3)
-                            self.log_monitor[str(p.resolve())] = {
-                                'size': p.stat().st_size,
-                                'mtime': p.stat().st_mtime
-                            }
-                            self.watch_sent_time[str(p.resolve())] = time.time()
-                            self.watch_sent_time[task] = time.time()
-            except Exception as e:
-                print(e, file=sys.stderr)
-            await asyncio.sleep(5)
+        self.sendmsg(title, report, 3, Dispatcher.PRIORITY_ALERT)
+        self.state.put(str(p), st, time.time())
+        self.state.set_task_alert_time(task, time.time())
+        return False
+
+    def task_name(self, p):
+        classified = self.watch_rules().classify(str(p))
+        if classified is None:
+            return p.stem
+        return classified[0]
+
+    def log_task(self, p, st=None):
+        classified = self.watch_rules().classify(str(p))
+        if classified is None or classified[1] is None:
+            return None
+        if st is None:
+            st = p.stat()
+        file_date = datetime.datetime.fromtimestamp(st.st_mtime)
+        if datetime.datetime.now() - file_date >= datetime.timedelta(days=1):
+            return None
+        task, state = classified[0], classified[1]
+        return task, {
+            'state': state,
+            'logdate': file_date.strftime('%Y-%m-%d %H:%M:%S'),
+            'detail': self.summarizer.summary(p, st, 50, 120)
+        }
 
-    def scan_logs(self):
+    def scan_logs(self, cancel=None):
         print(f'[{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] scan_logs')
+        with self.metrics.timer('olog_scan_logs_seconds'):
+            return self.scan_log_dirs(cancel)
+
+    def scan_log_dirs(self, cancel=None):
+        found = self.scanner.scan_tasks(self.watch_rules(), cancel)
         tasks = {}
-        for log_dir in self.olog_cfg['log_dirs']:
-            log_dir = pathlib.Path(log_dir)
-            for p in log_dir.glob('**/*'):
-                ext = p.suffix.lower()[1:] 
-                if ext not in ['log', 'err', 'scanerr']:
-                    continue
-                file_date = datetime.datetime.fromtimestamp(p.stat().st_mtime)
-                results = re.findall(r'@(.*?)@', p.stem)
-                if results:
-                    task = results[0]
-                else:
-                    task = p.stem
-                if datetime.datetime.now() - file_date > datetime.timedelta(days=self.olog_cfg['log_keep_days']):
-                    os.remove(p)
-                elif datetime.datetime.now() - file_date < datetime.timedelta(days=1):
-                    if ext == 'log':
-                        state = 'ok'
-                    elif ext in ['err', 'scanerr']:
-                        state = 'err'
-                    with p.open('r', encoding='utf-8') as fr:
-                        detail = fr.read()
-                        if len(detail) > 120:
-                            detail = detail[:50] + '...\n......\n...' + detail[-50:]
-                    tasks[task] = {
-                        'state': state,
-                        'logdate': file_date.strftime('%Y-%m-%d %H:%M:%S'),
-                        'detail': detail
-                    }
+        for task, (mtime, path) in found.items():
+            try:
+                result = self.log_task(pathlib.Path(path))
+            except FileNotFoundError:
+                continue
+            if result is not None:
+                tasks[result[0]] = result[1]
         return tasks
 
     async def client(self):
@@ -238,33 +1814,254 @@ report time: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
             try:
                 print(f'[NOTICE] connecting {self.ws_uri}')
                 async with websockets.connect(self.ws_uri) as websocket:
-                    payload = self.add_auth(self.olog_cfg['device'])
-                    await websocket.send(payload)
+                    channel = Channel(self, websocket)
+                    await asyncio.wait_for(channel.login(self.olog_cfg['device']), 30)
                     print(f'[NOTICE] connected {self.ws_uri}')
-                    while True:
-                        recv = await websocket.recv()
-                        recv = self.fetch_auth(recv)
-                        if recv == 'report now':
-                            report = self.scan_logs()
-                            report = json.dumps(report)
-                            payload = self.add_auth(report)
-                            await websocket.send(payload)
-                        elif recv == 'ping':
-                            payload = self.add_auth('pong')
-                            await websocket.send(payload)
+                    reader = asyncio.ensure_future(channel.serve())
+                    try:
+                        # one full snapshot per connection, then watch streams the deltas
+                        cancel = threading.Event()
+                        tasks = await self.run_blocking(self.scan_logs, cancel, timeout=self.olog_cfg.get('io_timeout', 600), cancel=cancel)
+                        self.task_states = dict(tasks)
+                        await channel.send('state', {'full': True, 'tasks': tasks})
+                        # changes seen while the snapshot was scanned may be newer than what it found
+                        unsent, self.unsent_deltas = self.unsent_deltas, {}
+                        self.channel = channel
+                        deltas = {task: info for task, info in unsent.items() if self.newer(info, tasks.get(task)) and info != tasks.get(task)}
+                        if deltas:
+                            self.task_states.update(deltas)
+                            await channel.send('state', {'full': False, 'tasks': deltas})
+                        await reader
+                    finally:
+                        self.channel = None
+                        reader.cancel()
             except Exception as e:
                 print(e, file=sys.stderr)
                 await asyncio.sleep(10)
 
+    def read_chunks(self, paths, budget):
+        files = []
+        chunks = []
+        done = []
+        for path in sorted(paths):
+            if budget <= 0:
+                break
+            p = pathlib.Path(path)
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                self.state.forget(path)
+                done.append(path)
+                continue
+            offset = self.state.get_offset(path, st)
+            # no recorded offset, a truncated or a replaced file: the server restarts its copy
+            reset = offset is None or st.st_size < offset
+            if reset:
+                offset = 0
+            if st.st_size == offset:
+                done.append(path)
+                continue
+            with p.open('rb') as fr:
+                fr.seek(offset)
+                data = fr.read(min(st.st_size - offset, budget))
+            budget -= len(data)
+            chunks.append(data)
+            files.append({
+                'path': path,
+                'task': self.task_name(p),
+                'name': p.name,
+                # same-named files in different directories must not share one copy on the server
+                'parts': list(p.parts[1:]),
+                'offset': offset,
+                'size': len(data),
+                'reset': reset,
+                'st': st
+            })
+        return files, zlib.compress(b''.join(chunks)), done
+
+    def commit_chunks(self, files):
+        done = []
+        for f in files:
+            self.state.set_offset(f['path'], f['st'], f['offset'] + f['size'])
+            if f['offset'] + f['size'] >= f['st'].st_size:
+                done.append(f['path'])
+        self.state.commit()
+        return done
+
+    async def forward(self):
+        while True:
+            try:
+                channel = self.channel
+                if channel is None or not self.forward_pending:
+                    await asyncio.sleep(1)
+                    continue
+                files, data, done = await self.run_blocking(self.read_chunks, set(self.forward_pending), self.olog_cfg.get('forward_batch_bytes', 256 * 1024))
+                self.forward_pending.difference_update(done)
+                if not files:
+                    continue
+                reply = await channel.request('chunk', {
+                    'files': [{key: f[key] for key in ['task', 'name', 'parts', 'offset', 'size', 'reset']} for f in files]
+                }, timeout=60, blob=data)
+                if reply == 'ok':
+                    self.forward_pending.difference_update(await self.run_blocking(self.commit_chunks, files))
+                else:
+                    print(f'[ERROR] forward rejected: {reply}', file=sys.stderr)
+                    await asyncio.sleep(10)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                await asyncio.sleep(5)
+
+
+class ReportRenderer:
+
+    def __init__(self, template_path):
+        self.template_path = pathlib.Path(template_path)
+        self.template_mtime = None
+        self.template = []
+        self.fragments = {}
+
+    def load_template(self):
+        mtime = self.template_path.stat().st_mtime
+        if mtime != self.template_mtime:
+            with self.template_path.open('r', encoding='utf-8') as fr:
+                self.template = re.split(r'(\{\{ index \}\}|\{\{ items \}\})', fr.read())
+            self.template_mtime = mtime
+        return self.template
+
+    def page(self, index, items):
+        parts = []
+        for part in self.load_template():
+            if part == '{{ index }}':
+                parts.append(index)
+            elif part == '{{ items }}':
+                parts.extend(items)
+            else:
+                parts.append(part)
+        return parts
+
+    def prune(self, devices):
+        for device in set(self.fragments.keys()) - set(devices):
+            del self.fragments[device]
+
+    def device(self, device, tasks, known_tasks, version=None):
+        # unchanged devices reuse their rendered fragment; version is bumped by the server on every update
+        if version is None and tasks != 'LOST':
+            version = tuple((task, info['state'], info['detail']) for task, info in tasks.items())
+        key = (
+            tasks == 'LOST',
+            None if known_tasks is None else tuple(known_tasks),
+            version,
+            len(tasks)
+        )
+        cached = self.fragments.get(device)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        result = self.render_device(device, tasks, known_tasks)
+        self.fragments[device] = (key, result)
+        return result
+
+    def render_device(self, device, tasks, known_tasks):
+        if known_tasks is None:
+            known_tasks = []
+            not_in_tasks_flag = ' [NEW]'
+        else:
+            not_in_tasks_flag = ''
+        if tasks == 'LOST':
+            is_device_lost = True
+            tasks = {}
+        else:
+            is_device_lost = False
+        lost_tasks = [task for task in known_tasks if task not in tasks]
+        known = set(known_tasks)
+        new_tasks = []
+        lost_task_count = len(lost_tasks)
+        err_task_count = 0
+        ok_task_count = 0
+        device_name = device.split('#')[0] if '#' in device else device
+        device_addr = device.split('#')[1] if '#' in device else 'Addr not assign'
+        device_info = [f'<div class="mdui-panel-item-body"><p>{device_addr}</p><div class="mdui-panel" mdui-panel>']
+        append = device_info.append
+        for task, info in tasks.items():
+            if task not in known:
+                known.add(task)
+                new_tasks.append(task)
+                task += ' [NEW]'
+                not_in_tasks_flag = ' [NEW]'
+            state = info['state']
+            if state == 'err':
+                err_task_count += 1
+                append(f'''<div class="mdui-panel-item">
+                        <div class="mdui-panel-item-header mdui-color-orange-900">{task}</div>
+                        <div class="mdui-panel-item-body"><p>{info["detail"]}</p></div></div>''')
+            elif state == 'ok':
+                ok_task_count += 1
+                append(f'''<div class="mdui-panel-item">
+                        <div class="mdui-panel-item-header mdui-color-green">{task}</div>
+                        <div class="mdui-panel-item-body"><p>{info["detail"]}</p></div></div>''')
+            elif state == 'lost':
+                lost_task_count += 1
+                append(f'''<div class="mdui-panel-item">
+                        <div class="mdui-panel-item-header mdui-color-red-900">{task}</div>
+                        <div class="mdui-panel-item-body"><p>LOST: {device_addr}</p></div></div>''')
+            else:
+                append('<div class="mdui-panel-item"></div>')
+        for task in lost_tasks:
+            append(f'''<div class="mdui-panel-item">
+                        <div class="mdui-panel-item-header mdui-color-red-900">{task}</div>
+                        <div class="mdui-panel-item-body"><p>LOST: {device_addr}</p></div></div>''')
+        append('</div></div>')
+        if is_device_lost:
+            status = 'lost'
+            item_color_class = 'mdui-color-red-900'
+            device_title = f'''<div class="mdui-panel-item-title mdui-color-red-900">{device_name}{not_in_tasks_flag}</div>
+                    <div class="mdui-panel-item-summary mdui-color-red-900">DEVICE LOST</div>'''
+        elif err_task_count + lost_task_count > 0:
+            status = 'err'
+            item_color_class = 'mdui-color-orange-900'
+            device_title = f'''<div class="mdui-panel-item-title">{device_name}{not_in_tasks_flag}</div>
+                    <div class="mdui-panel-item-summary">
+                        <a class="mdui-color-red-900">{lost_task_count} LOST</a>, 
+                        <a class="mdui-color-orange-900">{err_task_count} ERR</a>, 
+                        <a class="mdui-color-green">{ok_task_count} OK</a>
+                    </div>'''
+        else:
+            status = 'ok'
+            item_color_class = 'mdui-color-green'
+            device_title = f'''<div class="mdui-panel-item-title mdui-color-green">{device_name}{not_in_tasks_flag}</div>
+                    <div class="mdui-panel-item-summary">
+                        <a class="mdui-color-green">OK</a>
+                    </div>'''
+        device_title = f'<div class="mdui-panel-item-header {item_color_class}">' + device_title + '<i class="mdui-panel-item-arrow mdui-icon material-icons">keyboard_arrow_down</i></div>'
+        html = f'<div class="mdui-panel-item">{device_title}{"".join(device_info)}</div>'
+        return html, status, new_tasks
+
 
 class OlogSvr(Olog):
 
-    def __init__(self):
-        super().__init__()
-        self.lock = asyncio.Lock()
+    def __init__(self, olog_cfg_path=None):
+        super().__init__(olog_cfg_path)
         self.reports = {}
+        self.online = collections.Counter()
+        self.relayed = {}
+        self.report_versions = collections.Counter()
+        self.heartbeat = HeartbeatScheduler(self, self.heartbeat_expired)
+        self.retention = RetentionService(self, self.olog_cfg.get('retention_path') or pathlib.Path(__file__).parent / 'olog_retention.db')
+        self.history = HistoryStore(self.olog_cfg.get('history_path') or pathlib.Path(__file__).parent / 'olog_history.db')
+        self.renderer = ReportRenderer(pathlib.Path(__file__).parent / 'reports.html')
+        self.known_tasks_path = pathlib.Path(self.olog_cfg.get('tasks_state_path') or pathlib.Path(__file__).parent / 'olog_tasks.json')
         self.last_report_time = datetime.datetime.now() - datetime.timedelta(days=1) + datetime.timedelta(minutes=2)
-        self.last_scan_time = self.last_report_time - datetime.timedelta(minutes=1)
+
+    def collect_metrics(self, metrics):
+        super().collect_metrics(metrics)
+        metrics.set('olog_connected_devices', len(self.online))
+        metrics.set('olog_online_devices', len(self.online_devices()))
+
+    def online_devices(self):
+        # devices connected here plus the ones relays report as connected to them
+        online = set(self.online)
+        for devices in self.relayed.values():
+            online.update(devices)
+        return online
 
     def today_report_time(self, time):
         today = datetime.datetime.now().strftime('%Y-%m-%d')
@@ -286,13 +2083,14 @@ class OlogSvr(Olog):
 {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 '''
         print(f'[WARNING] device offline: {device}', file=sys.stderr)
-        self.sendmsg(title, report, 3)
+        self.sendmsg(title, report, 3, Dispatcher.PRIORITY_ALERT)
     
-    async def ws_svr(self, websocket, path):
-        async with self.lock:
-            from_device = await websocket.recv()
-        from_device = self.fetch_auth(from_device)
-        if not from_device:
+    async def ws_svr(self, websocket, path=None):
+        channel = Channel(self, websocket)
+        try:
+            from_device = await asyncio.wait_for(channel.accept(), 30)
+        except Exception as e:
+            print(f'[ERROR] handshake failed: {e}', file=sys.stderr)
             return False
         if '#' in from_device:
             from_device_name, from_device_addr = from_device.split('#')
@@ -300,51 +2098,112 @@ class OlogSvr(Olog):
             from_device_name, from_device_addr = from_device, 'Addr not assign'
         print(f'[NOTICE] new device {from_device_name}')
         self.sendmsg(f'New Device Connected: {from_device_name}', f'New Device Connected: {from_device}', 3)
-        while True:
+        channel.handler = functools.partial(self.on_message, from_device)
+        self.online[from_device] += 1
+        token = self.heartbeat.register(channel, from_device)
+        try:
             try:
-                if self.reports.get(from_device, None) is None:
-                    payload = self.add_auth('report now')
-                    async with self.lock:
-                        await websocket.send(payload)
-                        recv = await websocket.recv()
-                    recv = self.fetch_auth(recv)
-                    if not recv:
-                        return False
-                    report = json.loads(recv)
-                    self.reports[from_device] = report
-                payload = self.add_auth('ping')
-                async with self.lock:
-                    await websocket.send(payload)
-                    recv = await websocket.recv()
-                recv = self.fetch_auth(recv)
-                if not recv:
-                    return False
-                if recv != 'pong':
-                    raise Exception(f'[ERROR] {from_device} ping pong error!')
-                await asyncio.sleep(5)
+                await channel.serve()
             except websockets.exceptions.ConnectionClosed:
+                pass
+            if not channel.expired:
                 self.device_offline(from_device)
-                break
-            except Exception as e:
-                print(e, file=sys.stderr)
-    
+        finally:
+            self.heartbeat.unregister(token)
+            self.online[from_device] -= 1
+            if self.online[from_device] <= 0:
+                del self.online[from_device]
+                self.relayed.pop(from_device, None)
+                self.metrics.remove('olog_device_rtt_seconds', device=from_device_name)
+
+    def retention_policies(self):
+        if not self.olog_cfg.get('htmldir'):
+            return {}
+        self.retention.seed('html', self.olog_cfg['htmldir'], '**/*.html')
+        return {'html': (self.olog_cfg.get('html_keep_days', 7), None, None)}
+
+    def heartbeat_expired(self, channel, device):
+        channel.expired = True
+        self.device_offline(device)
+        # a half-open connection never reports ConnectionClosed by itself
+        asyncio.ensure_future(channel.websocket.close())
+
+    async def on_message(self, device, channel, type_, data, blob):
+        if type_ == 'state':
+            self.update_state(device, data.get('full'), data['tasks'])
+        elif type_ == 'chunk':
+            return await self.store_chunks(device, data, blob)
+        elif type_ == 'relay_state':
+            for relayed_device, state in data['devices'].items():
+                self.update_state(relayed_device, state['full'], state['tasks'])
+        elif type_ == 'relay_online':
+            self.relayed[device] = set(data['devices'])
+        elif type_ == 'relay_chunk':
+            return await self.store_chunks(data['device'], data, blob)
+        elif type_ == 'alert':
+            self.sendmsg(data['title'], data['content'], data['type_'], data['priority'])
+
+    def update_state(self, device, full, tasks):
+        self.history.append(device, tasks)
+        self.report_versions[device] += 1
+        if full:
+            self.reports[device] = tasks
+        else:
+            self.reports.setdefault(device, {}).update(tasks)
+
+    async def store_chunks(self, device, data, blob):
+        if not self.olog_cfg.get('forward_dir'):
+            return 'forward_dir not configured'
+        await asyncio.get_event_loop().run_in_executor(None, self.write_chunks, device, data, blob)
+        return 'ok'
+
+    def safe_name(self, name):
+        return re.sub(r'[^\w.@-]', '_', name).lstrip('.') or '_'
+
+    def write_chunks(self, device, data, blob):
+        blob = zlib.decompress(blob)
+        device_dir = pathlib.Path(self.olog_cfg['forward_dir']) / self.safe_name(device.split('#')[0])
+        start = 0
+        for f in data['files']:
+            chunk = blob[start:start + f['size']]
+            start += f['size']
+            path = device_dir.joinpath(self.safe_name(f['task']), *[self.safe_name(part) for part in f.get('parts') or [f['name']]])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if f['reset']:
+                mode = 'wb'
+            else:
+                mode = 'ab'
+                # a resent chunk overlaps what is already written
+                size = path.stat().st_size if path.exists() else 0
+                chunk = chunk[max(0, size - f['offset']):]
+            with path.open(mode) as fw:
+                fw.write(chunk)
+
+    def report_snapshot(self):
+        expire = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+        snapshot = {}
+        online = self.online_devices()
+        for device, tasks in self.reports.items():
+            if device not in online:
+                snapshot[device] = 'LOST'
+            else:
+                snapshot[device] = {task: info for task, info in tasks.items() if info['logdate'] > expire}
+        return snapshot
+
     async def gather_report(self):
         while True:
             try:
-                if datetime.datetime.now() - self.last_scan_time >= datetime.timedelta(days=1):
-                    print('reports init...')
-                    self.reports = {}
-                    self.last_scan_time = self.today_report_time(self.olog_cfg['report_time']) - datetime.timedelta(minutes=5)
+                self.history.flush()
                 if datetime.datetime.now() - self.last_report_time >= datetime.timedelta(days=1):
                     title = f'Olog daily report [{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}]'
-                    html = self.gen_html(self.reports)
+                    html = self.render_report(self.report_snapshot(), self.report_versions)
                     if self.olog_cfg.get('htmldir'):
                         htmlurl = self.save_html(html)
                         content = f'<a href="{htmlurl}">{htmlurl}</a>'
-                        self.sendmsg(title, content, 2)
+                        self.sendmsg(title, content, 2, Dispatcher.PRIORITY_ALERT)
                         self.last_report_time = self.today_report_time(self.olog_cfg['report_time'])
                     else:
-                        self.sendmsg(title, html, 2)
+                        self.sendmsg(title, ''.join(html), 2, Dispatcher.PRIORITY_ALERT)
                         self.last_report_time = self.today_report_time(self.olog_cfg['report_time'])
                     await asyncio.sleep(60)
             except Exception as e:
@@ -354,119 +2213,198 @@ class OlogSvr(Olog):
     def run(self):
         print('[BEGIN] running as websocket server...')
         self.sendmsg(f'{self.device} running as server...', f'{self.device} running as server...\n\n---\n\n{self.addr}\n\nNext report time: {(self.last_report_time + datetime.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")}', 3)
-        start_server = websockets.serve(self.ws_svr, '0.0.0.0', self.olog_cfg['svr_port'])
-        asyncio.get_event_loop().run_until_complete(asyncio.gather(start_server, self.gather_report(), self.wechat_send()))
+        start_server = websockets.serve(self.ws_svr, '0.0.0.0', self.olog_cfg['svr_port'], ping_interval=None, max_size=self.olog_cfg.get('ws_max_size', 16 * 1024 * 1024))
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(start_server, self.gather_report(), self.heartbeat.run(), self.retention.run(), self.dispatcher.run(), self.serve_metrics()))
         asyncio.get_event_loop().run_forever()
 
-    def gen_html(self, reports):
+    def load_known_tasks(self):
+        known = {device: list(tasks) for device, tasks in self.olog_cfg.get('device_tasks', {}).items()}
+        if self.known_tasks_path.exists():
+            with self.known_tasks_path.open('r', encoding='utf-8') as fr:
+                for device, tasks in json.load(fr).items():
+                    if device not in known:
+                        known[device] = tasks
+                    else:
+                        seen = set(known[device])
+                        known[device].extend(task for task in tasks if task not in seen)
+        return known
+
+    def render_report(self, reports, versions=None):
+        with self.metrics.timer('olog_gen_html_seconds'):
+            return self.render_report_parts(reports, versions)
+
+    def render_report_parts(self, reports, versions=None):
         self.read_olog_config()
-        reports_html_templates_path = pathlib.Path(__file__).parent / 'reports.html'
-        with reports_html_templates_path.open('r', encoding='utf-8') as fr:
-            html = fr.read()
-        items = ''
-        lost_devices_count = 0
-        err_devices_count = 0
-        ok_devices_count = 0
-        for device in self.olog_cfg.get('device_tasks', {}).keys():
+        known = self.load_known_tasks()
+        reports = dict(reports)
+        for device in known.keys():
             if reports.get(device, None) is None:
                 reports[device] = 'LOST'
-                lost_devices_count += 1
+        items = []
+        counts = {'lost': 0, 'err': 0, 'ok': 0}
+        changed = False
         for device, tasks in reports.items():
-            lost_task_count = 0
-            err_task_count = 0
-            ok_task_count = 0
-            if device not in self.olog_cfg.get('device_tasks', {}).keys():
-                if not self.olog_cfg.get('device_tasks'):
-                    self.olog_cfg['device_tasks'] = {}
-                self.olog_cfg['device_tasks'][device] = []
-                not_in_tasks_flag = ' [NEW]'
-            else:
-                not_in_tasks_flag = ''
-            if tasks == 'LOST':
-                is_device_lost = True
-                tasks = {}
-            else:
-                is_device_lost = False
-            for task in self.olog_cfg['device_tasks'][device]:
-                if task not in tasks:
-                    tasks[task] = {'state': 'lost', 'logdate': '', 'detail': ''}
-            device_name = device.split('#')[0] if '#' in device else device
-            device_addr = device.split('#')[1] if '#' in device else 'Addr not assign'
-            device_info = f'<div class="mdui-panel-item-body"><p>{device_addr}</p><div class="mdui-panel" mdui-panel>'
-            for task, info in tasks.items():
-                if task not in self.olog_cfg['device_tasks'][device]:
-                    self.olog_cfg['device_tasks'][device].append(task)
-                    task += ' [NEW]'
-                    if not not_in_tasks_flag:
-                        not_in_tasks_flag = ' [NEW]'
-                device_info += '<div class="mdui-panel-item">'
-                if info['state'] == 'err':
-                    err_task_count += 1
-                    device_info += f'''
-                        <div class="mdui-panel-item-header mdui-color-orange-900">{task}</div>
-                        <div class="mdui-panel-item-body"><p>{info["detail"]}</p></div>'''
-                elif info['state'] == 'ok':
-                    ok_task_count += 1
-                    device_info += f'''
-                        <div class="mdui-panel-item-header mdui-color-green">{task}</div>
-                        <div class="mdui-panel-item-body"><p>{info["detail"]}</p></div>'''
-                elif info['state'] == 'lost':
-                    lost_task_count += 1
-                    device_info += f'''
-                        <div class="mdui-panel-item-header mdui-color-red-900">{task}</div>
-                        <div class="mdui-panel-item-body"><p>LOST: {device_addr}</p></div>'''
-                device_info += '</div>'
-            device_info += '</div></div>'
-            if is_device_lost:
-                item_color_class = 'mdui-color-red-900'
-                device_title = f'''<div class="mdui-panel-item-title mdui-color-red-900">{device_name}{not_in_tasks_flag}</div>
-                    <div class="mdui-panel-item-summary mdui-color-red-900">DEVICE LOST</div>'''
-            elif err_task_count + lost_task_count > 0:
-                item_color_class = 'mdui-color-orange-900'
-                device_title = f'''<div class="mdui-panel-item-title">{device_name}{not_in_tasks_flag}</div>
-                    <div class="mdui-panel-item-summary">
-                        <a class="mdui-color-red-900">{lost_task_count} LOST</a>, 
-                        <a class="mdui-color-orange-900">{err_task_count} ERR</a>, 
-                        <a class="mdui-color-green">{ok_task_count} OK</a>
-                    </div>'''
-                err_devices_count += 1
-            else:
-                item_color_class = 'mdui-color-green'
-                device_title = f'''<div class="mdui-panel-item-title mdui-color-green">{device_name}{not_in_tasks_flag}</div>
-                    <div class="mdui-panel-item-summary">
-                        <a class="mdui-color-green">OK</a>
-                    </div>'''
-                ok_devices_count += 1
-            device_title = f'<div class="mdui-panel-item-header {item_color_class}">' + device_title + '<i class="mdui-panel-item-arrow mdui-icon material-icons">keyboard_arrow_down</i></div>'
-            items += f'<div class="mdui-panel-item">{device_title}{device_info}</div>'
+            html, status, new_tasks = self.renderer.device(device, tasks, known.get(device), versions.get(device) if versions else None)
+            if device not in known or new_tasks:
+                known.setdefault(device, []).extend(new_tasks)
+                changed = True
+            counts[status] += 1
+            items.append(html)
+        self.renderer.prune(reports.keys())
+        if changed:
+            # write beside and swap, a torn file would break every later render
+            tmp = self.known_tasks_path.with_name(self.known_tasks_path.name + '.tmp')
+            with tmp.open('w', encoding='utf-8') as fw:
+                json.dump(dict(sorted(known.items())), fw, separators=(',', ':'))
+            os.replace(tmp, self.known_tasks_path)
         index = f'''<h2>{self.device}</h2><p>{self.addr}</p><p>report time: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")} | 
-            <a class="mdui-text-color-red-900">{lost_devices_count} LOST</a>,
-            <a class="mdui-text-color-orange-900">{err_devices_count} ERR</a>,
-            <a class="mdui-text-color-green"> {ok_devices_count} OK</a></p>'''
-        html = html.replace('{{ index }}', index).replace('{{ items }}', items)
-        with self.olog_cfg_path.open('w', encoding='utf-8') as fw:
-            json.dump(self.olog_cfg, fw, sort_keys=True, indent=4, separators=(',', ':'))
-        return html
-    
+            <a class="mdui-text-color-red-900">{counts['lost']} LOST</a>,
+            <a class="mdui-text-color-orange-900">{counts['err']} ERR</a>,
+            <a class="mdui-text-color-green"> {counts['ok']} OK</a></p>'''
+        return self.renderer.page(index, items)
+
+    def gen_html(self, reports):
+        return ''.join(self.render_report(reports))
+
     def save_html(self, html):
         htmldir = self.olog_cfg['htmldir']
         htmlurl = self.olog_cfg['htmlurl']
         filename = hashlib.sha256((str(time.time()) + self.olog_cfg['token']).encode('utf-8')).hexdigest() + '.html'
         htmlpath = pathlib.Path(htmldir) / filename
-        for p in pathlib.Path(htmldir).glob('**/*.html'):
-            if time.time() - p.stat().st_mtime > 24 * 3600 * 7:
-                os.remove(p)
         htmlpath.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(html, str):
+            html = [html]
         with htmlpath.open('w', encoding='utf-8') as fw:
-            fw.write(html)
+            fw.writelines(html)
+        self.retention.track(htmlpath, htmlpath.stat().st_mtime, 'html')
+        self.retention.commit()
         return htmlurl + filename
 
 
+class OlogRelay(OlogSvr):
+
+    def __init__(self, olog_cfg_path=None):
+        super().__init__(olog_cfg_path)
+        self.upstream = None
+        self.pending_states = {}
+        self.pending_alerts = collections.deque()
+        self.online_sent = None
+
+    def sendmsg(self, title, content, type_, priority=1):
+        # alerts raised here are pushed by the upstream server, or locally while it is unreachable
+        if self.upstream is None:
+            super().sendmsg(title, content, type_, priority)
+        else:
+            self.pending_alerts.append({'title': title, 'content': content, 'type_': type_, 'priority': priority})
+
+    def update_state(self, device, full, tasks):
+        self.report_versions[device] += 1
+        pending = self.pending_states.get(device)
+        if full:
+            self.reports[device] = tasks
+            self.pending_states[device] = {'full': True, 'tasks': dict(tasks)}
+        else:
+            self.reports.setdefault(device, {}).update(tasks)
+            if pending is None:
+                self.pending_states[device] = {'full': False, 'tasks': dict(tasks)}
+            else:
+                pending['tasks'].update(tasks)
+
+    async def store_chunks(self, device, data, blob):
+        channel = self.upstream
+        if channel is None:
+            return 'relay upstream not connected'
+        return await channel.request('relay_chunk', dict(data, device=device), timeout=60, blob=blob)
+
+    async def flush(self, channel):
+        states, self.pending_states = self.pending_states, {}
+        # a full snapshot of thousands of devices would exceed the upstream frame limit, so send it in batches
+        limit = self.olog_cfg.get('relay_batch_bytes', 256 * 1024)
+        batch = {}
+        size = 0
+        for device, state in states.items():
+            state_size = len(json.dumps(state, separators=(',', ':'))) + len(device)
+            if batch and size + state_size > limit:
+                await channel.send('relay_state', {'devices': batch})
+                batch = {}
+                size = 0
+            batch[device] = state
+            size += state_size
+        if batch:
+            await channel.send('relay_state', {'devices': batch})
+        online = sorted(self.online_devices())
+        if online != self.online_sent:
+            await channel.send('relay_online', {'devices': online})
+            self.online_sent = online
+        while self.pending_alerts:
+            alert = self.pending_alerts.popleft()
+            try:
+                await channel.send('alert', alert)
+            except Exception:
+                self.pending_alerts.appendleft(alert)
+                raise
+
+    async def relay(self):
+        while True:
+            try:
+                print(f'[NOTICE] relay connecting {self.ws_uri}')
+                async with websockets.connect(self.ws_uri) as websocket:
+                    channel = Channel(self, websocket)
+                    await asyncio.wait_for(channel.login(self.olog_cfg['device']), 30)
+                    print(f'[NOTICE] relay connected {self.ws_uri}')
+                    reader = asyncio.ensure_future(channel.serve())
+                    try:
+                        # the upstream may have lost everything, so every connection starts from a full snapshot
+                        self.pending_states = {device: {'full': True, 'tasks': dict(tasks)} for device, tasks in self.reports.items()}
+                        self.online_sent = None
+                        self.upstream = channel
+                        while not reader.done():
+                            await self.flush(channel)
+                            await asyncio.wait([reader], timeout=self.olog_cfg.get('relay_interval', 1))
+                    finally:
+                        self.upstream = None
+                        reader.cancel()
+                        while self.pending_alerts:
+                            super().sendmsg(**self.pending_alerts.popleft())
+            except Exception as e:
+                print(e, file=sys.stderr)
+                await asyncio.sleep(10)
+
+    def run(self):
+        print('[BEGIN] running as relay...')
+        self.sendmsg(f'{self.device} running as relay...', f'{self.device} running as relay...\n\n---\n\n{self.addr}\n\nUpstream: {self.ws_uri}', 3)
+        start_server = websockets.serve(self.ws_svr, '0.0.0.0', self.olog_cfg['relay_port'], ping_interval=None, max_size=self.olog_cfg.get('ws_max_size', 16 * 1024 * 1024))
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(start_server, self.relay(), self.heartbeat.run(), self.dispatcher.run(), self.serve_metrics()))
+        asyncio.get_event_loop().run_forever()
+
+
+class OlogHistory(Olog):
+
+    def __init__(self, olog_cfg_path=None):
+        super().__init__(olog_cfg_path)
+        self.store = HistoryStore(self.olog_cfg.get('history_path') or pathlib.Path(__file__).parent / 'olog_history.db')
+
+    def time_range(self, days, since, until):
+        until = datetime.datetime.fromisoformat(str(until)) if until else datetime.datetime.now()
+        since = datetime.datetime.fromisoformat(str(since)) if since else until - datetime.timedelta(days=days)
+        return since, until
+
+    def query(self, device=None, task=None, days=7, since=None, until=None, limit=1000):
+        since, until = self.time_range(days, since, until)
+        return self.store.query(device, task, since, until, limit)
+
+    def stats(self, device=None, task=None, days=30, since=None, until=None):
+        since, until = self.time_range(days, since, until)
+        return self.store.stats(device, task, since, until)
+
+
 class Pipeline:
 
     def __init__(self):
         self.server = OlogSvr()
         self.client = OlogClient()
+        self.relay = OlogRelay()
+        self.history = OlogHistory()
 
 
 if __name__ == '__main__':